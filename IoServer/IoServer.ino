@@ -61,4 +61,7 @@ void loop() {
   
   if(Serial.available())
     parser.parse(Serial.read());
+
+  // report changes on subscribed inputs
+  parser.poll();
 }
@@ -44,7 +44,88 @@ extern WebUSB WebUSBSerial;
 #define ERR_ILL_TYPE    18  // illegal (counter) type specification
 #define ERR_INC_I2C     19  // incomplete i2c request
 
+// binary protocol errors
+#define ERR_BIN_CRC     20  // checksum mismatch
+#define ERR_BIN_LEN     21  // wrong payload length
+#define ERR_BIN_OP      22  // unknown opcode
+
+// binary frames are <sync> <len> <opcode> <payload> <crc>. The length
+// covers opcode and payload, the crc covers length, opcode and payload
+#define BIN_SYNC      0xa5
+
+// host to ftDuino opcodes
+#define OP_SET_O      0x01  // port, mode, value (0xffff: none)
+#define OP_SET_M      0x02  // port, mode, value (0xffff: none)
+#define OP_SET_I      0x03  // port, mode
+#define OP_GET_I      0x04  // port
+#define OP_GET_C      0x05  // port, type (0: state, 1: counter)
+#define OP_GET_ALL    0x06  // -
+#define OP_SUBSCRIBE  0x07  // index (I1-I8: 0-7, C1-C4: 8-11), on, threshold
+#define OP_CLEAR_C    0x08  // port
+#define OP_VERSION    0x09  // -
+
+// ftDuino to host opcodes
+#define OP_VALUE      0x81  // index (i2c: 0xff), flags, value [, data]
+#define OP_ALL        0x82  // switch mask, I1-I8 values, C1-C4 values
+#define OP_EVENT      0x83  // index, flags, value
+#define OP_VERSION_R  0x84  // version string
+#define OP_ERROR      0xff  // error code
+
+#define FLAG_BOOL     0x01  // value is a truth value
+
+// analog inputs subscribed without a threshold ignore changes up to
+// this (mV or ohms), so their jitter doesn't flood the link. Counters
+// report every change
+#define SUB_THRESHOLD 10
+
+#define VERSION       "0.9.5"
+
+#ifdef ARDUINO
+// keep track of input modes. These are also needed to decide how
+// subscribed inputs are to be reported
+static uint8_t input_mode[8] = {
+  Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE,
+  Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE
+};
+#endif
+
+static uint8_t crc8(uint8_t crc, uint8_t c) {
+  crc ^= c;
+  for(uint8_t i=0;i<8;i++)
+    crc = (crc & 0x80)?((crc << 1) ^ 0x07):(crc << 1);
+  return crc;
+}
+
+void JsonParser::reply_binary(uint8_t op, const uint8_t *data, uint8_t len) {
+  uint8_t crc = crc8(crc8(0, len+1), op);
+  for(uint8_t i=0;i<len;i++)
+    crc = crc8(crc, data[i]);
+  
+#ifdef ARDUINO
+  Serial.write(BIN_SYNC);
+  Serial.write(len+1);
+  Serial.write(op);
+  Serial.write(data, len);
+  Serial.write(crc);
+  Serial.flush();
+#else
+  printf("binary reply %02x, %d bytes\n", op, len);
+#endif
+}
+
+// index of a port named "I1".."I8" or "C1".."C4" as used in binary frames
+static uint8_t port_index(const char *port) {
+  if(port[0] == 'I') return port[1] - '1';
+  if(port[0] == 'C') return 8 + port[1] - '1';
+  return 0xff;
+}
+
 void JsonParser::reply_error(char id) {
+  if(binary) {
+    reply_binary(OP_ERROR, (uint8_t*)&id, 1);
+    return;
+  }
+  
 #ifdef ARDUINO
   Serial.print("{ \"error\": ");
   Serial.print(id, DEC);
@@ -58,6 +139,17 @@ void JsonParser::reply_error(char id) {
 
 #ifdef ARDUINO
 void JsonParser::reply_value(char *port, bool b, uint16_t v, uint8_t *data, uint8_t data_len) {
+  if(binary) {
+    uint8_t buf[4 + data_len];
+    buf[0] = port_index(port);
+    buf[1] = b?FLAG_BOOL:0;
+    buf[2] = v & 0xff;
+    buf[3] = v >> 8;
+    if(data) memcpy(buf+4, data, data_len);
+    reply_binary(OP_VALUE, buf, data?(4+data_len):4);
+    return;
+  }
+  
   Serial.print("{ \"port\": \"");
   Serial.print(port);
   Serial.print("\", \"value\": ");
@@ -81,6 +173,24 @@ void JsonParser::reply_value(char *port, bool b, uint16_t v, uint8_t *data, uint
   Serial.print("}");
   Serial.flush();
 }
+
+// unrequested notification about a changed subscribed port
+void JsonParser::reply_event(char *port, bool b, uint16_t v) {
+  if(binary) {
+    uint8_t buf[4] = { port_index(port), (uint8_t)(b?FLAG_BOOL:0),
+		       (uint8_t)(v & 0xff), (uint8_t)(v >> 8) };
+    reply_binary(OP_EVENT, buf, 4);
+    return;
+  }
+  
+  Serial.print("{ \"event\": \"");
+  Serial.print(port);
+  Serial.print("\", \"value\": ");
+  if(b) Serial.print(v?"true":"false");
+  else  Serial.print(v, DEC);
+  Serial.print(" }");
+  Serial.flush();
+}
 #endif
 
 JsonParser::JsonParser() {
@@ -101,6 +211,7 @@ void JsonParser::cmd_reset(void) {
   port.type = port::PORT_NONE;
   value.valid = false;
   value.length = 0;
+  subscribe.valid = 0;
 }
 
 void JsonParser::reset(void) {
@@ -112,6 +223,13 @@ void JsonParser::reset(void) {
   // ftduino specific state
   cmd_reset();
 
+  // nothing is being reported unrequested anymore
+  subscribed = 0;
+
+  // always (re-)start in json mode
+  binary = false;
+  bin.pos = 0;
+
 #ifdef ARDUINO
   // all counter inputs trigger on falling edge and clear them
   for(uint8_t c=0;c<4;c++) {
@@ -174,6 +292,10 @@ void JsonParser::check_name(void) {
       parm = PARM_REG;
     else if(strcmp(substate_value.value.str, "len") == 0)
       parm = PARM_LEN;
+    else if(strcmp(substate_value.value.str, "subscribe") == 0)
+      parm = PARM_SUBSCRIBE;
+    else if(strcmp(substate_value.value.str, "threshold") == 0)
+      parm = PARM_THRESHOLD;
     else
       reply_error(ERR_UNK_PARM);   
   }
@@ -232,6 +354,8 @@ void JsonParser::check_value(void) {
 	  req = REQ_DEVS;
         else if(startsWith(substate_value.value.str, "version"))
           req = REQ_VER;
+        else if(startsWith(substate_value.value.str, "all"))
+          req = REQ_ALL;
       	else
 	  reply_error(ERR_ILL_REQ);
       } else
@@ -266,6 +390,15 @@ void JsonParser::check_value(void) {
   }
       
   if(cmd == CMD_SET) {
+    // a single string requests a protocol switch
+    if(depth == 0) {
+      if((substate_value.type == value::TYPE_STR) &&
+	 startsWith(substate_value.value.str, "binary"))
+	req = REQ_BINARY;
+      else
+	reply_error(ERR_ILL_REQ);
+    }
+    
     // parse with respect to the parameter name
     // all set parameters are within sub-objects at depth 1
     if(depth == 1) {
@@ -329,6 +462,20 @@ void JsonParser::check_value(void) {
       	} else
 	  reply_error(ERR_WRONG_VTYPE);
 	
+      } else if(parm == PARM_SUBSCRIBE) {
+	if(substate_value.type == value::TYPE_BOOL) {
+	  subscribe.valid |= 1;
+	  subscribe.on = substate_value.value.bin;
+	} else
+	  reply_error(ERR_WRONG_VTYPE);
+	
+      } else if(parm == PARM_THRESHOLD) {
+	if(substate_value.type == value::TYPE_NUM) {
+	  subscribe.valid |= 2;
+	  subscribe.threshold = substate_value.value.num;
+	} else
+	  reply_error(ERR_WRONG_VTYPE);
+	
       } else if(parm == PARM_VALUE) {
         if(substate_value.type == value::TYPE_NUM) {
 	  if(state == ARRAY) {	    
@@ -397,15 +544,10 @@ void JsonParser::cmd_complete(void) {
     Ftduino::OFF, Ftduino::OFF, Ftduino::OFF, Ftduino::OFF, 
     Ftduino::OFF, Ftduino::OFF, Ftduino::OFF, Ftduino::OFF
   };
-  // ... and motor modes ...
+  // ... and motor modes
   static uint8_t motor_mode[4] = {
     Ftduino::OFF, Ftduino::OFF, Ftduino::OFF, Ftduino::OFF
   };
-  // ... and input modes
-  static uint8_t input_mode[8] = {
-    Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE,
-    Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE, Ftduino::RESISTANCE
-  };
 #endif
   
   switch(cmd) {
@@ -489,17 +631,74 @@ void JsonParser::cmd_complete(void) {
     
     if(req == REQ_VER) {
 #ifdef ARDUINO
-      // currently only one master is supported
-      Serial.print("{ \"version\": \"0.9.2\" }");
-      Serial.flush();
+      if(binary)
+	reply_binary(OP_VERSION_R, (const uint8_t*)VERSION, strlen(VERSION));
+      else {
+	Serial.print("{ \"version\": \"" VERSION "\" }");
+	Serial.flush();
+      }
 #else
       printf("Version request\n");
 #endif
     }
+
+    if(req == REQ_ALL) {
+#ifdef ARDUINO
+      if(binary) {
+	// switch mask followed by 8 input and 4 counter values
+	uint8_t buf[1+2*12] = { 0 };
+	for(uint8_t i=0;i<12;i++) {
+	  uint16_t v;
+	  if(i < 8) {
+	    v = ftduino.input_get(Ftduino::I1 + i);
+	    if(input_mode[i] == Ftduino::SWITCH) buf[0] |= 1<<i;
+	  } else
+	    v = ftduino.counter_get(Ftduino::C1 + i - 8);
+	  buf[1+2*i] = v & 0xff;
+	  buf[2+2*i] = v >> 8;
+	}
+	reply_binary(OP_ALL, buf, sizeof(buf));
+	break;
+      }
+      
+      // all inputs and counters in one reply
+      Serial.print("{ \"inputs\": [ ");
+      for(uint8_t i=0;i<8;i++) {
+	uint16_t v = ftduino.input_get(Ftduino::I1 + i);
+	if(input_mode[i] == Ftduino::SWITCH)
+	  Serial.print(v?"true":"false");
+	else
+	  Serial.print(v, DEC);
+	if(i != 7) Serial.print(", ");
+      }
+      Serial.print(" ], \"counters\": [ ");
+      for(uint8_t c=0;c<4;c++) {
+	Serial.print(ftduino.counter_get(Ftduino::C1 + c), DEC);
+	if(c != 3) Serial.print(", ");
+      }
+      Serial.print(" ] }");
+      Serial.flush();
+#else
+      printf("Get all request\n");
+#endif
+    }
     
     break;
     
   case CMD_SET:
+    if(req == REQ_BINARY) {
+      // acknowledge in json, everything after this is binary
+#ifdef ARDUINO
+      Serial.print("{ \"protocol\": \"binary\" }");
+      Serial.flush();
+#else
+      printf("switching to binary protocol\n");
+#endif
+      binary = true;
+      bin.pos = 0;
+      break;
+    }
+    
     switch(port.type) {
     case port::PORT_I2C:
       // we need an address and a register number
@@ -554,6 +753,10 @@ void JsonParser::cmd_complete(void) {
       break;
       
     case port::PORT_C:
+      if(subscribe.valid) {
+	set_subscription(8+port.index);
+	break;
+      }
 #ifdef ARDUINO
       ftduino.counter_clear(Ftduino::C1+port.index);
 #else
@@ -604,12 +807,17 @@ void JsonParser::cmd_complete(void) {
 #ifdef ARDUINO
 	  input_mode[port.index] = ftdm;
 	  ftduino.input_set_mode(Ftduino::I1+port.index, ftdm);
+	  // report subscribed input again in its new mode
+	  sub_reported &= ~(1<<port.index);
 #else
 	  printf("set I%d mode %d\n", port.index, ftdm);
 #endif
 	} else
 	  reply_error(ERR_INV_MODE);
       }
+
+      if(subscribe.valid)
+	set_subscription(port.index);
       break;
       
       // act according to output set commands
@@ -662,7 +870,198 @@ void JsonParser::cmd_complete(void) {
   cmd_reset();
 }
   
+// subscription index 0-7 are the inputs I1-I8, 8-11 the counters C1-C4
+void JsonParser::set_subscription(uint8_t index) {
+  if(subscribe.valid & 1) {
+    if(subscribe.on) subscribed |=  (1<<index);
+    else             subscribed &= ~(1<<index);
+  }
+  
+  if(subscribe.valid & 2)
+    sub_threshold[index] = subscribe.threshold;
+  else if(subscribe.valid & 1)
+    sub_threshold[index] = (index < 8)?SUB_THRESHOLD:0;
+  
+  // make sure the current state is reported once
+  sub_reported &= ~(1<<index);
+}
+
+// called frequently from the main loop to report changes on
+// subscribed inputs and counters
+void JsonParser::poll(void) {
+  if(!subscribed) return;
+
+  for(uint8_t i=0;i<12;i++) {
+    if(!(subscribed & (1<<i))) continue;
+
+#ifdef ARDUINO
+    bool b;
+    uint16_t v;
+    if(i < 8) {
+      v = ftduino.input_get(Ftduino::I1 + i);
+      b = input_mode[i] == Ftduino::SWITCH;
+    } else {
+      v = ftduino.counter_get(Ftduino::C1 + i - 8);
+      b = false;
+    }
+
+    if(sub_reported & (1<<i)) {
+      // analog values are only reported if they differ by more
+      // than the threshold from the last reported value
+      uint16_t diff = (v > sub_last[i])?(v - sub_last[i]):(sub_last[i] - v);
+      if(!diff || (!b && (diff <= sub_threshold[i])))
+	continue;
+    }
+      
+    char port_name[3] = { (char)((i<8)?'I':'C'), (char)('1' + ((i<8)?i:(i-8))), 0 };
+    reply_event(port_name, b, v);
+    sub_last[i] = v;
+    sub_reported |= (1<<i);
+#endif
+  }
+}
+
+// collect a binary frame byte by byte
+int JsonParser::parse_binary(uint8_t c) {
+  if(bin.pos == 0) {
+    // outside a frame a null-byte or ESC returns to json mode. Inside
+    // a frame they are just data, so the host sends a run of null-bytes
+    // longer than any frame to get back to json mode from anywhere
+    if(c == BIN_SYNC)          bin.pos = 1;
+    else if(!c || (c == 0x1b)) reset();
+    return 0;
+  }
+
+  if(bin.pos == 1) {
+    // a broken length makes us wait for the next sync byte
+    if(!c || (c > sizeof(bin.buf))) bin.pos = 0;
+    else {
+      bin.len = c;
+      bin.crc = crc8(0, c);
+      bin.pos = 2;
+    }
+    return 0;
+  }
+
+  if(bin.pos < 2 + bin.len) {
+    bin.buf[bin.pos - 2] = c;
+    bin.crc = crc8(bin.crc, c);
+    bin.pos++;
+    return 0;
+  }
+
+  // this is the crc byte
+  bin.pos = 0;
+  if(c != bin.crc) reply_error(ERR_BIN_CRC);
+  else             binary_command();
+  
+  return 0;
+}
+
+// translate a binary frame into the same state the json parser
+// would have produced and run it
+void JsonParser::binary_command(void) {
+  static const uint8_t payload_len[] = { 0, 4, 4, 2, 1, 2, 0, 4, 1, 0 };
+  uint8_t op = bin.buf[0];
+  uint8_t *p = bin.buf + 1;
+
+  cmd_reset();
+  
+  if(!op || (op >= sizeof(payload_len))) {
+    reply_error(ERR_BIN_OP);
+    return;
+  }
+
+  if(bin.len - 1 != payload_len[op]) {
+    reply_error(ERR_BIN_LEN);
+    return;
+  }
+
+  // check port index range
+  uint8_t max_index = 0;
+  switch(op) {
+  case OP_SET_O: case OP_SET_I: case OP_GET_I: max_index = 8;  break;
+  case OP_SET_M: case OP_GET_C: case OP_CLEAR_C: max_index = 4;  break;
+  case OP_SUBSCRIBE: max_index = 12; break;
+  }
+  if(max_index && (p[0] >= max_index)) {
+    reply_error(ERR_ILL_PORT);
+    return;
+  }
+
+  // modes are transmitted as mode_e values
+  if(((op == OP_SET_O) || (op == OP_SET_M) || (op == OP_SET_I)) &&
+     (p[1] > MODE_BRAKE)) {
+    reply_error(ERR_ILL_MODE);
+    return;
+  }
+  
+  switch(op) {
+  case OP_SET_O:
+  case OP_SET_M:
+    cmd = CMD_SET;
+    port.type = (op == OP_SET_O)?port::PORT_O:port::PORT_M;
+    port.index = p[0];
+    mode = (mode_e)p[1];
+    if((p[2] != 0xff) || (p[3] != 0xff)) {
+      value.valid = true;
+      value.type = VALUE_TYPE_NUM;
+      value.v = p[2] | (p[3] << 8);
+    }
+    break;
+
+  case OP_SET_I:
+    cmd = CMD_SET;
+    port.type = port::PORT_I;
+    port.index = p[0];
+    mode = (mode_e)p[1];
+    break;
+      
+  case OP_GET_I:
+    cmd = CMD_GET;
+    port.type = port::PORT_I;
+    port.index = p[0];
+    break;
+    
+  case OP_GET_C:
+    cmd = CMD_GET;
+    port.type = port::PORT_C;
+    port.index = p[0];
+    type = p[1]?TYPE_COUNTER:TYPE_STATE;
+    break;
+
+  case OP_CLEAR_C:
+    cmd = CMD_SET;
+    port.type = port::PORT_C;
+    port.index = p[0];
+    break;
+    
+  case OP_GET_ALL:
+    cmd = CMD_GET;
+    req = REQ_ALL;
+    break;
+
+  case OP_VERSION:
+    cmd = CMD_GET;
+    req = REQ_VER;
+    break;
+
+  case OP_SUBSCRIBE:
+    subscribe.valid = 3;
+    subscribe.on = p[1];
+    subscribe.threshold = p[2] | (p[3] << 8);
+    set_subscription(p[0]);
+    cmd_reset();
+    return;
+  }
+
+  cmd_complete();
+}
+
 int JsonParser::parse(char c) {
+  if(binary)
+    return parse_binary((uint8_t)c);
+  
 #ifdef ARDUINOx
   digitalWrite(LED_BUILTIN, HI);
   delay(10);
@@ -8,11 +8,17 @@ class JsonParser
   public:
     JsonParser();
     int parse(char c);
+    void poll(void);
     void reset(void);
       
  private:
     void reply_error(char id);
     void reply_value(char *port, bool b, uint16_t v, uint8_t *data, uint8_t data_len);
+    void reply_event(char *port, bool b, uint16_t v);
+    void reply_binary(uint8_t op, const uint8_t *data, uint8_t len);
+    int parse_binary(uint8_t c);
+    void binary_command(void);
+    void set_subscription(uint8_t index);
 
     bool isWhite(char c);
     bool isDigit(char c);
@@ -35,16 +41,18 @@ class JsonParser
 
     // ftduino specific state information
     enum { CMD_NONE, CMD_SET, CMD_GET } cmd;
+    // the numeric mode values are also used by the binary protocol
     enum mode_e { MODE_NONE,
 	   MODE_U, MODE_R, MODE_SW,            // I1-I8 input modes
 	   MODE_HI, MODE_LO, MODE_OPEN,        // O1-O8 output modes
 	   MODE_LEFT, MODE_RIGHT, MODE_BRAKE,  // M1-M4 motor modes
     } mode;
     enum { PARM_NONE,
-	   PARM_PORT, PARM_VALUE, PARM_MODE, PARM_TYPE, PARM_ADDR, PARM_REG, PARM_LEN
+	   PARM_PORT, PARM_VALUE, PARM_MODE, PARM_TYPE, PARM_ADDR, PARM_REG, PARM_LEN,
+	   PARM_SUBSCRIBE, PARM_THRESHOLD
     } parm;
     enum { REQ_NONE,
-	   REQ_DEVS, REQ_VER
+	   REQ_DEVS, REQ_VER, REQ_ALL, REQ_BINARY
     } req;
     enum { TYPE_NONE, TYPE_STATE, TYPE_COUNTER,
     } type;
@@ -70,6 +78,27 @@ class JsonParser
       };
     } value;
 
+    struct {
+      uint8_t valid;   // bit 0: subscribe, bit 1: threshold
+      bool on;
+      uint16_t threshold;
+    } subscribe;
+
+    // I1-I8 and C1-C4 reported on change
+    uint16_t subscribed;      // bit mask of subscribed ports
+    uint16_t sub_reported;    // bit mask of ports reported at least once
+    uint16_t sub_threshold[12];
+    uint16_t sub_last[12];
+
+    // binary protocol state
+    bool binary;
+    struct {
+      uint8_t pos;     // 0: waiting for sync, 1: length, 2..: opcode/payload
+      uint8_t len;
+      uint8_t crc;
+      uint8_t buf[40];
+    } bin;
+    
     struct mode_map_S { mode_e mode; uint8_t ftd_mode; };
     static const struct mode_map_S o_mode_map[], i_mode_map[], m_mode_map[];
     uint8_t getFtdMode(mode_e mode, const struct mode_map_S *m);
@@ -7,18 +7,18 @@ T.ApplicationWindow {
     title: "SofTXT"
     
     id: win
-    signal execScript (string script, bool ret)
-    signal execResultStr (string result)
-    signal execResultBool (bool result)
+    signal execScript (string script, int request)
+    signal execResultStr (int request, string result)
+    signal execResultBool (int request, bool result)
     
     onExecScript: {
 	  // run script and return result if requested
 	  var retval = eval(script)
-	  if(ret) {
+	  if(request) {
 		  if(typeof(retval) == "boolean")
-		    	  win.execResultBool(retval)
+		    	  win.execResultBool(request, retval)
 		  else
-		    	  win.execResultStr(retval)
+		    	  win.execResultStr(request, retval)
 	  }
     }
 
@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# frame_decoder.py
+#
+# Replay recorded IoServer output through the old byte-by-byte
+# decoder and through the json_framer used by ftduino.poll() and
+# report frames per second and syscalls per frame.
+#
+# python3 benchmarks/frame_decoder.py [-n frames]
+
+import argparse, json, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.factories import json_framer
+
+# replies as they are printed by IoServer/JsonParser.cpp
+RECORDING = (
+    b'{ "port": "I1", "value": true }'
+    b'{ "port": "I2", "value": "1532" }'
+    b'{ "port": "I3", "value": false }'
+    b'{ "port": "C1", "value": "42" }'
+    b'{ "port": "I4", "value": "9870" }'
+    b'{ "version": "0.9.2" }'
+    b'{ "error": 11 }'
+    b'{ "port": "i2c", "value": "2" }'
+)
+RECORDED_FRAMES = 8
+
+USB_PACKET = 64   # bytes a full speed CDC device delivers at once
+
+# serial port replaying a recording. Bytes become available in
+# USB packet sized chunks and every select() and read() is counted
+class replay_port():
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.avail = 0
+        self.syscalls = 0
+
+    def select(self):
+        self.syscalls += 1
+        if not self.avail:
+            self.avail = min(USB_PACKET, len(self.data) - self.pos)
+        return self.avail > 0
+
+    @property
+    def in_waiting(self):
+        self.syscalls += 1
+        return self.avail
+
+    def read(self, size=1):
+        self.syscalls += 1
+        size = min(size, self.avail)
+        chunk = self.data[self.pos:self.pos+size]
+        self.pos += size
+        self.avail -= size
+        return chunk
+
+# the decoder as it used to be in ftduino.poll()
+def legacy_decode(port):
+    frames = 0
+    msg = ""
+    while port.select():
+        msg += port.read().decode()
+        try:
+            json.loads(msg)
+            frames += 1
+            msg = ""
+        except:
+            pass
+    return frames
+
+def framer_decode(port):
+    frames = 0
+    framer = json_framer()
+    while port.select():
+        frames += len(framer.feed(port.read(port.in_waiting or 1)))
+    return frames
+
+def bench(name, decoder, frames):
+    port = replay_port(RECORDING * (frames // RECORDED_FRAMES))
+    start = time.perf_counter()
+    decoded = decoder(port)
+    duration = time.perf_counter() - start
+    print("{:8s} {:7d} frames  {:10.0f} frames/s  {:6.2f} syscalls/frame".format(
+        name, decoded, decoded / duration, port.syscalls / decoded))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark IoServer frame decoding")
+    parser.add_argument("-n", "--frames", type=int, default=20000,
+                        help="Number of frames to replay")
+    args = parser.parse_args()
+
+    bench("legacy", legacy_decode, args.frames)
+    bench("framer", framer_decode, args.frames)
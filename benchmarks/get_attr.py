@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# get_attr.py
+#
+# Measure how many get_attr() calls per second app threads get
+# through and how much cpu they burn while waiting for the gui. A
+# display with one label per thread is loaded the way run.py does, and
+# every thread checks that it gets the text of its own label back.
+# Both ways get_attr() has are measured: plain properties are read
+# through the property binding, anything else is evaluated by the qml
+# side and comes back with the request id. The latter is exercised by
+# reading an expression. Also reported is the rate of set_attr()
+# calls the gui keeps up with and how many of them actually had to be
+# applied to the display.
+#
+# python3 benchmarks/get_attr.py [-n calls] [-t threads]
+
+import argparse, os, sys, tempfile, threading, time
+
+BASE = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BASE)
+import run
+from run import QApplication, QQmlApplicationEngine, pyqtSignal
+
+DISPLAY_QML = """import QtQuick 2.9
+import QtQuick.Window 2.0
+TXTWindow {
+%s}
+"""
+LABEL = '    TXTLabel { id: label%d; text: "%d" }\n'
+
+# what the threads read on each path, label index inserted
+ITEMS = [ ( "property", "label%d.text" ), ( "eval", "label%d.text.toString()" ) ]
+
+class bench_app(run.RunApplication):
+    done = pyqtSignal()
+
+    # only what get_attr() needs, no project and no controller
+    def __init__(self, calls, threads):
+        QApplication.__init__(self, [ sys.argv[0] ])
+        self.handlers = { }
+        self.binding = None
+        self.requests = { }
+        self.request_id = 0
+        self.requests_lock = threading.Lock()
+        self.engine = QQmlApplicationEngine()
+        self.engine.addImportPath(BASE)
+
+        self.path = tempfile.mkdtemp() + "/"
+        os.mkdir(self.path + "lib")
+        with open(self.path + "lib/display.qml", "w") as f:
+            f.write(DISPLAY_QML % "".join(LABEL % (t, t) for t in range(threads)))
+        self.runDisplay()
+
+        self.calls = calls
+        self.results = [ None ] * threads
+        self.done.connect(self.quit)
+
+    def worker(self, index, item):
+        item = item % index
+        start, cpu = time.perf_counter(), time.thread_time()
+        for i in range(self.calls):
+            if self.get_attr(item) != str(index):
+                raise RuntimeError("thread %d got a foreign result" % index)
+        self.results[index] = (time.perf_counter() - start, time.thread_time() - cpu)
+
+    def bench_set(self):
+        applied = self.binding.applied
+        start = time.perf_counter()
+        for i in range(self.calls):
+            self.set_attr("label0.text", str(i))
+        # returns once the gui has caught up
+        if self.get_attr("label0.text") != str(self.calls - 1):
+            raise RuntimeError("lost a set_attr()")
+        duration = time.perf_counter() - start
+        print("set_attr              {:8.0f} calls/s  {:6.1f} us/call  {} of {} applied".format(
+            self.calls / duration, duration / self.calls * 1e6,
+            self.binding.applied - applied, self.calls))
+
+    def bench_get(self, path, item):
+        threads = [ threading.Thread(target=self.worker, args=(t, item)) for t in range(len(self.results)) ]
+        requests = self.request_id
+        start, cpu = time.perf_counter(), time.process_time()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+        calls = self.calls * len(threads)
+        if (self.request_id - requests == calls) != (path == "eval"):
+            raise RuntimeError("get_attr() took the wrong path for " + item)
+        waiting = sum(c for w, c in self.results) / sum(w for w, c in self.results)
+        print("{:8s} {:3d} threads  {:8.0f} calls/s  {:6.1f} us/call  "
+              "app threads {:5.1f} % cpu  process {:5.1f} % cpu".format(
+                  path, len(threads), calls / wall, wall / calls * 1e6, 100 * waiting, 100 * cpu / wall))
+
+    def bench(self):
+        for path, item in ITEMS:
+            self.bench_get(path, item)
+        self.bench_set()
+        self.done.emit()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark get_attr() round trips")
+    parser.add_argument("-n", "--calls", type=int, default=5000,
+                        help="Number of calls per thread")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="Number of app threads calling at the same time")
+    args = parser.parse_args()
+
+    app = bench_app(args.calls, args.threads)
+    threading.Thread(target=app.bench, daemon=True).start()
+    app.exec_()
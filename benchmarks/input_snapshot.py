@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# input_snapshot.py
+#
+# Compare reading an input through ftduinod the old way (a
+# get_i_value() round trip over the socket and the serial link) with
+# reading it from the shared memory snapshot ftduinod keeps up to
+# date. ftduinod runs in this process with a simulated ftDuino, the
+# client talks to it through the Unix socket like an app does.
+#
+# python3 benchmarks/input_snapshot.py [-n reads] [-l latency]
+
+import argparse, os, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.factories import ftduino, input_snapshot, snapshot_path
+from fischertechnik.simulator import simulator
+import ftduinod
+
+def bench(name, read, reads):
+    start = time.perf_counter()
+    for i in range(reads): read()
+    duration = time.perf_counter() - start
+    print("{:14s} {:10.2f} us/read".format(name, duration / reads * 1e6))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the shared input snapshot")
+    parser.add_argument("-n", "--reads", type=int, default=2000,
+                        help="Number of reads per test")
+    parser.add_argument("-l", "--latency", type=float, default=.001,
+                        help="Reply latency of the simulated ftDuino in seconds")
+    args = parser.parse_args()
+
+    sim = simulator(latency=args.latency, baudrate=115200)
+    sim.script("i1", lambda t: int(t * 1000) % 4096)
+
+    path = os.path.join(tempfile.mkdtemp(), "ftduinod.sock")
+    snapshot = input_snapshot(snapshot_path(path), create=True)
+    controller = ftduino(device="sim", backend=sim.open)
+    server = ftduinod.server(path, ftduinod.owner(controller, snapshot))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ["FTDUINO_SOCKET"] = path
+    client = ftduino()
+
+    bench("get_i_value", lambda: client.get_i_value(1), args.reads)
+
+    # let ftduinod notice the reader and start sampling
+    client.get_input("i1", .05)
+    time.sleep(.2)
+    hits = client.cache["hits"]
+    bench("get_input", lambda: client.get_input("i1", .05), args.reads * 100)
+    print("{:14s} {:10.1f} %".format("snapshot hits",
+                                     100 * (client.cache["hits"] - hits) / (args.reads * 100)))
+    bench("snapshot read", client.snapshot.read, args.reads * 100)
+
+    client.close()
+    controller.close()
+    server.server_close()
+    os.unlink(path)
+    os.unlink(snapshot_path(path))
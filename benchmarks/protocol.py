@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# protocol.py
+#
+# Compare the json and the binary IoServer protocol against a
+# simulated ftDuino. The simulated device answers like the IoServer
+# sketch does, the serial link is modelled by its baud rate (8N1).
+# Reported are the bytes on the wire, the host side cpu time and the
+# resulting throughput of output commands and the latency of a full
+# input sweep.
+#
+# python3 benchmarks/protocol.py [-n commands] [-b baudrate]
+
+import argparse, os, struct, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.factories import json_framer, binary_framer
+
+# a device that answers commands like IoServer/JsonParser.cpp does
+class simulated_ioserver():
+    def __init__(self, binary):
+        self.binary = binary
+        self.framer = json_framer()
+        self.buffer = bytearray()
+        self.inputs = [ 1532, 1, 0, 9870, 0, 0, 12, 0 ]
+        self.counters = [ 42, 0, 0, 7 ]
+
+    def feed(self, data):
+        if self.binary: return self.feed_binary(data)
+
+        reply = b""
+        for cmd in self.framer.feed(data):
+            if cmd.get("get") == "all":
+                reply += ('{ "inputs": [ ' + ", ".join(str(v) for v in self.inputs) +
+                          ' ], "counters": [ ' + ", ".join(str(v) for v in self.counters) +
+                          ' ] }').encode()
+        return reply
+
+    def feed_binary(self, data):
+        reply = b""
+        self.buffer += data
+        while len(self.buffer) >= 2 and len(self.buffer) >= self.buffer[1] + 3:
+            length, op = self.buffer[1], self.buffer[2]
+            assert binary_framer.crc(self.buffer[1:length+2]) == self.buffer[length+2]
+            del self.buffer[:length+3]
+            if op == binary_framer.OP_GET_ALL:
+                reply += binary_framer.frame(binary_framer.OP_ALL,
+                            struct.pack("<B12H", 0, *(self.inputs + self.counters)))
+        return reply
+
+def wire_time(nbytes, baud):
+    return nbytes * 10 / baud
+
+def bench(name, codec, device, commands, baud):
+    # output commands as sent by e.g. led.set_brightness() in a loop
+    tx = 0
+    start = time.process_time()
+    for i in range(commands):
+        data = codec.encode({ "set": { "port": "o"+str(1+i%8), "value": i%256, "mode": "high" } })
+        device.feed(data)
+        tx += len(data)
+    set_cpu = (time.process_time() - start) / commands
+    set_bytes = tx / commands
+    set_rate = 1 / (wire_time(set_bytes, baud) + set_cpu)
+
+    # full input sweeps: request and wait for the reply
+    tx = rx = 0
+    start = time.process_time()
+    for i in range(commands):
+        data = codec.encode({ "get": "all" })
+        reply = device.feed(data)
+        assert len(codec.feed(reply)) == 1
+        tx += len(data)
+        rx += len(reply)
+    get_cpu = (time.process_time() - start) / commands
+    get_latency = wire_time((tx + rx) / commands, baud) + get_cpu
+
+    print("{:6s}  set: {:5.1f} bytes {:6.1f} us cpu {:7.0f} cmds/s   "
+          "get all: {:5.1f} bytes {:6.1f} us cpu {:6.2f} ms".format(
+              name, set_bytes, set_cpu * 1e6, set_rate,
+              (tx + rx) / commands, get_cpu * 1e6, get_latency * 1e3))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark IoServer protocols")
+    parser.add_argument("-n", "--commands", type=int, default=10000,
+                        help="Number of commands per test")
+    parser.add_argument("-b", "--baud", type=int, default=115200,
+                        help="Baud rate of the simulated serial link")
+    args = parser.parse_args()
+
+    bench("json", json_framer(), simulated_ioserver(False), args.commands, args.baud)
+    bench("binary", binary_framer(), simulated_ioserver(True), args.commands, args.baud)
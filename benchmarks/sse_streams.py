@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# sse_streams.py
+#
+# Start txt-4.0.py, open N server sent event streams the way the
+# RoboPro web ui does (console, inputs and counters in turn) and
+# report how long it took until every stream delivered its first
+# data event as well as the resident memory and thread count of the
+# server with all streams open. The inputs and counters come from the
+# simulated ftDuino.
+#
+# python3 benchmarks/sse_streams.py [-n streams] [-p port]
+
+import argparse, asyncio, os, signal, subprocess, sys, time
+
+BASE = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SERVER = os.path.join(BASE, "txt-4.0.py")
+
+STREAMS = ( "/api/v1/controller/0/message-stream",
+            "/api/v1/controller/0/inputs/message-stream",
+            "/api/v1/controller/0/counters/message-stream" )
+
+# VmRSS and Threads of a process as reported by the kernel
+def process_status(pid):
+    status = { }
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ( "VmRSS", "Threads" ): status[key] = value.split()[0]
+    return int(status["VmRSS"]), int(status["Threads"])
+
+async def open_stream(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write("GET {} HTTP/1.0\r\nHost: localhost\r\n\r\n".format(path).encode())
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")      # headers
+    # skip keepalive comments
+    while not (await reader.readuntil(b"\n\n")).startswith(b"data:"):
+        pass
+    return writer
+
+async def wait_for_server(port):
+    for i in range(100):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(.1)
+    raise RuntimeError("server did not come up")
+
+async def bench(pid, port, streams, hold, timeout):
+    await wait_for_server(port)
+    idle = process_status(pid)
+
+    start = time.perf_counter()
+    writers = await asyncio.wait_for(
+        asyncio.gather(*[ open_stream(port, STREAMS[i % len(STREAMS)])
+                          for i in range(streams) ]), timeout)
+    duration = time.perf_counter() - start
+
+    # let the streams run for a while before sampling the server
+    await asyncio.sleep(hold)
+    busy = process_status(pid)
+
+    for writer in writers: writer.close()
+
+    print("{:5d} streams  first data after {:6.3f} s   "
+          "rss {:6d} -> {:6d} kB  threads {:3d} -> {:3d}".format(
+              streams, duration, idle[0], busy[0], idle[1], busy[1]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark concurrent SSE streams")
+    parser.add_argument("-n", "--streams", type=int, default=200,
+                        help="Number of streams to open")
+    parser.add_argument("-p", "--port", type=int, default=8765,
+                        help="Port to run the server on")
+    parser.add_argument("--hold", type=float, default=2,
+                        help="Seconds to keep the streams open before sampling")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="Seconds to wait for all streams to open")
+    args = parser.parse_args()
+
+    # in a session of its own, so ftduinod and the app runners it
+    # starts can be stopped along with it
+    server = subprocess.Popen([ sys.executable, SERVER, "-l", "127.0.0.1", "-p", str(args.port),
+                                "--ftduino-device", "sim" ],
+                              stdout=subprocess.DEVNULL, cwd=BASE, start_new_session=True)
+    try:
+        asyncio.run(bench(server.pid, args.port, args.streams, args.hold, args.timeout))
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
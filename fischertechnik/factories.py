@@ -2,120 +2,915 @@
 # factories.py - ftDuino interface and factory API 
 #
 
-import threading, time
+import threading, time, queue, os, socket, mmap
 
-import serial, json, select, math
+import serial, json, math, re, struct
 import serial.tools.list_ports
+from collections import deque
+from concurrent import futures
 
 from fischertechnik.controller.Motor import Motor
 
 from sensors import bmx055
 
 FTDUINO_VIDPID = "1c40:0538"
+FTDUINO_BAUDRATE = 115200  # as used by the IoServer sketch
+RECONNECT_DELAY = (.5, 10)  # first and maximum delay between reconnect attempts
 POLL_DELAY = .1  # poll inputs every 100ms for "Starte jedes mal" blocks
+ALL_VERSION = (0, 9, 3)  # first IoServer version answering "get all"
+PUSH_VERSION = (0, 9, 4)  # first IoServer version reporting input changes itself
+BINARY_VERSION = (0, 9, 5)  # first IoServer version speaking the binary protocol
+COALESCE_DELAY = .005  # output changes within this time are sent together
+SAMPLE_INTERVAL = .02  # background sampling of inputs while the app reads them
+SAMPLE_IDLE = 1        # stop sampling if the app hasn't read inputs for this long
+PUSH_THRESHOLD = 10    # default minimum change of analog inputs pushed (mV or ohms)
+SNAPSHOT_TIMEOUT = .01  # give up on a snapshot that stays inconsistent this long
+
+ALL_PORTS = [ "i"+str(i+1) for i in range(8) ] + [ "c"+str(c+1) for c in range(4) ]
+
+# split the byte stream coming from the IoServer into complete top
+# level json objects. Each object is decoded exactly once when its
+# closing brace has been seen.
+class json_framer():
+    SPECIAL = re.compile(rb'[{}"\\]')   # the only bytes the scanner cares about
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.rest = b""        # bytes following a protocol switch
+        self.reset()
+
+    def encode(self, cmd):
+        return json.dumps(cmd).encode()
+
+    def reset(self):
+        self.buffer.clear()
+        self.pos = 0           # scan position within buffer
+        self.start = 0         # start of current top level object
+        self.depth = 0
+        self.in_string = False
+        
+    def feed(self, data):
+        self.buffer += data
+        frames = [ ]
 
-# this in fact does not implement a TXT but an ftDuino ...
-class ftduino():
-    def __init__(self, ext = None):
-        if ext != None:
-            # later we might search for multiple ftDuino's
-            print("WARNING: Ignoring request for extension controller")
-            return
+        buf = self.buffer
+        pos = self.pos
+        self.rest = b""
+        while True:
+            m = json_framer.SPECIAL.search(buf, pos)
+            if not m: break
+            c = buf[m.start()]
+            pos = m.end()
+            
+            if self.in_string:
+                if c == 0x5c:    pos += 1                 # skip escaped char
+                elif c == 0x22:  self.in_string = False
+            elif c == 0x22:
+                # strings outside of objects are just garbage
+                if self.depth: self.in_string = True
+            elif c == 0x7b:
+                if not self.depth: self.start = m.start()
+                self.depth += 1
+            elif c == 0x7d and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    try:
+                        frames.append(json.loads(buf[self.start:pos]))
+                    except ValueError:
+                        continue   # broken frame, ignore it
+
+                    # the ftDuino won't talk json after a protocol switch
+                    if "protocol" in frames[-1]:
+                        self.rest = bytes(buf[pos:])
+                        pos = len(buf)
+                        break
+
+        # drop everything that has been consumed. Keep an incomplete
+        # object at the end of the buffer
+        if self.depth:
+            del buf[:self.start]
+            self.pos = pos - self.start
+            self.start = 0
+        else:
+            buf.clear()
+            self.pos = 0
+            
+        return frames
+
+def crc8_table(poly = 0x07):
+    table = [ ]
+    for c in range(256):
+        for i in range(8): c = ((c << 1) ^ poly) & 0xff if c & 0x80 else c << 1
+        table.append(c)
+    return table
+
+# binary frames are <sync> <len> <opcode> <payload> <crc>. The length
+# covers opcode and payload, the crc8 (polynomial 0x07) covers length,
+# opcode and payload. See IoServer/JsonParser.cpp for the opcodes.
+# Decoded frames look exactly like their json counterparts.
+class binary_framer():
+    SYNC = 0xa5
+    MAX_LEN = 40    # opcode and payload the IoServer can hold
+
+    # a null-byte or ESC only resets the IoServer between frames, inside
+    # a frame it's just data. Enough null-bytes to complete the longest
+    # frame the IoServer may still be collecting (or to break its length)
+    # make sure one of them arrives between frames
+    RESET = bytes(1 + MAX_LEN + 1) + b"\x1b"
+
+    # host to ftDuino
+    OP_SET_O, OP_SET_M, OP_SET_I, OP_GET_I, OP_GET_C = 0x01, 0x02, 0x03, 0x04, 0x05
+    OP_GET_ALL, OP_SUBSCRIBE, OP_CLEAR_C, OP_VERSION = 0x06, 0x07, 0x08, 0x09
+
+    # ftDuino to host
+    OP_VALUE, OP_ALL, OP_EVENT, OP_VERSION_R, OP_ERROR = 0x81, 0x82, 0x83, 0x84, 0xff
+
+    # mode_e values of the IoServer
+    MODES = { None: 0, "voltage": 1, "resistance": 2, "switch": 3,
+              "high": 4, "low": 5, "open": 6, "off": 6,
+              "left": 7, "right": 8, "brake": 9 }
+    
+    CRC8 = crc8_table()
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.rest = b""
+
+    def crc(data):
+        crc = 0
+        for c in data: crc = binary_framer.CRC8[crc ^ c]
+        return crc
+    
+    def frame(op, payload = b""):
+        data = bytes((len(payload)+1, op)) + payload
+        return bytes((binary_framer.SYNC,)) + data + bytes((binary_framer.crc(data),))
+
+    def port_name(index):
+        if index < 8:  return "I"+str(index+1)
+        if index < 12: return "C"+str(index-7)
+        return "i2c"
+
+    def mode(parms):
+        mode = parms.get("mode")
+        if not mode in binary_framer.MODES:
+            raise ValueError("Mode not supported by binary protocol: " + str(mode))
+        return binary_framer.MODES[mode]
+
+    # values are sent as unsigned 16 bit
+    def word(name, value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid " + name + ": " + repr(value))
+        if not 0 <= value <= 0xffff:
+            raise ValueError(name.capitalize() + " out of range 0..65535: " + str(value))
+        return value
+    
+    def encode(self, cmd):
+        # translate the json command as built by ftduino into binary
+        if "get" in cmd:
+            get = cmd["get"]
+            if get == "all":     return binary_framer.frame(binary_framer.OP_GET_ALL)
+            if get == "version": return binary_framer.frame(binary_framer.OP_VERSION)
+            port = get.get("port", "") if isinstance(get, dict) else ""
+            if port[:1] == "i" and port != "i2c":
+                return binary_framer.frame(binary_framer.OP_GET_I, bytes((int(port[1:])-1,)))
+            if port[:1] == "c":
+                counter = 1 if get.get("type") == "counter" else 0
+                return binary_framer.frame(binary_framer.OP_GET_C, bytes((int(port[1:])-1, counter)))
+
+        elif "set" in cmd and isinstance(cmd["set"], dict):
+            parms = cmd["set"]
+            port = parms.get("port", "")
+            index = int(port[1:]) - 1 if port[1:].isdigit() else None
+            if index != None and not 0 <= index < 8:
+                raise ValueError("Invalid port: " + port)
+
+            if index != None and "subscribe" in parms:
+                if port[0] == "c": index += 8
+                return binary_framer.frame(binary_framer.OP_SUBSCRIBE, struct.pack(
+                    "<BBH", index, bool(parms["subscribe"]),
+                    binary_framer.word("threshold", parms.get("threshold", push_threshold(port)))))
+            if index != None and port[0] in "om":
+                op = binary_framer.OP_SET_O if port[0] == "o" else binary_framer.OP_SET_M
+                return binary_framer.frame(op, struct.pack("<BBH", index, binary_framer.mode(parms),
+                    binary_framer.word("value", parms.get("value", 0xffff))))
+            if index != None and port[0] == "i":
+                return binary_framer.frame(binary_framer.OP_SET_I, bytes((index, binary_framer.mode(parms))))
+            if index != None and port[0] == "c":
+                return binary_framer.frame(binary_framer.OP_CLEAR_C, bytes((index,)))
+
+        raise ValueError("Command not supported by binary protocol: " + json.dumps(cmd))
         
-        # search for ftDuino on USB
-        ports = []
-        self.lock = threading.Lock()
+    def feed(self, data):
+        self.buffer += data
+        frames = [ ]
+
+        buf = self.buffer
+        while True:
+            # resync on the next sync byte
+            start = buf.find(binary_framer.SYNC)
+            if start < 0:
+                buf.clear()
+                break
+            del buf[:start]
+            if len(buf) < 2 or len(buf) < buf[1] + 3:
+                break  # incomplete
+            
+            length = buf[1]
+            if not length or binary_framer.crc(buf[1:length+2]) != buf[length+2]:
+                del buf[:1]   # not a valid frame, skip sync byte
+                continue
             
-        for p in serial.tools.list_ports.grep("vid:pid="+FTDUINO_VIDPID):
-                ports.append(p.device)
+            frame = self.decode(buf[2], bytes(buf[3:length+2]))
+            if frame: frames.append(frame)
+            del buf[:length+3]
+            
+        return frames
+
+    def decode(self, op, payload):
+        try:
+            if op == binary_framer.OP_VALUE or op == binary_framer.OP_EVENT:
+                index, flags, value = struct.unpack_from("<BBH", payload)
+                msg = { "port" if op == binary_framer.OP_VALUE else "event": binary_framer.port_name(index),
+                        "value": bool(value) if flags & 1 else value }
+                if len(payload) > 4: msg["data"] = list(payload[4:])
+                return msg
+            if op == binary_framer.OP_ALL:
+                values = struct.unpack_from("<B12H", payload)
+                return { "inputs": [ bool(v) if values[0] & (1<<i) else v for i,v in enumerate(values[1:9]) ],
+                         "counters": list(values[9:]) }
+            if op == binary_framer.OP_VERSION_R:
+                return { "version": payload.decode() }
+            if op == binary_framer.OP_ERROR:
+                return { "error": payload[0] }
+        except (struct.error, IndexError, UnicodeDecodeError):
+            pass
+        return None
+
+# all attached ftDuinos ordered by serial number, so the numbering of
+# extensions doesn't depend on the order they were plugged in
+def find_ftduinos():
+    ports = list(serial.tools.list_ports.grep("vid:pid="+FTDUINO_VIDPID))
+    ports.sort(key = lambda p: (p.serial_number or "", p.device))
+    return ports
+
+# ftduinod serves the master on the given path and the extensions
+# on paths with the extension index appended
+def socket_path(path, ext):
+    return path + "." + str(ext) if ext else path
+
+# the input snapshot ftduinod shares next to each socket
+def snapshot_path(path):
+    return path + ".inputs"
+
+# threshold of a subscription that doesn't name one. Inputs jitter,
+# counters only ever change for real
+def push_threshold(port):
+    return PUSH_THRESHOLD if port[:1] == "i" else 0
+
+# fixed layout shared memory with the last sample of all inputs and
+# counters. The owner of the ftDuino writes it under a seqlock: the
+# sequence is odd while an update is in progress and readers retry
+# until they saw the same even sequence before and after reading.
+# Readers store the time of their last read, so the owner knows
+# whether it's worth sampling
+class input_snapshot():
+    HEADER = struct.Struct("<Qd")          # sequence, last read by a client
+    # bitmask of switch values, I1-I8 modes, I1-I8 and C1-C4 values and times
+    PAYLOAD = struct.Struct("<H8B12i12d")
+    PORTS = [ "i"+str(i+1) for i in range(8) ] + [ "c"+str(c+1) for c in range(4) ]
+    MODES = [ None, "voltage", "resistance", "switch" ]
+
+    def __init__(self, path, create = False):
+        size = input_snapshot.HEADER.size + input_snapshot.PAYLOAD.size
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_TRUNC if create else 0), 0o600)
+        try:
+            if create: os.ftruncate(fd, size)
+            self.mem = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    # returns None if there's no snapshot
+    def open(path):
+        try:
+            return input_snapshot(path)
+        except (OSError, ValueError):
+            return None
+        
+    def write(self, values, times, modes):
+        mem = self.mem
+        seq = input_snapshot.HEADER.unpack_from(mem)[0] + 1
+        struct.pack_into("<Q", mem, 0, seq)
+
+        switches = 0
+        for i, port in enumerate(input_snapshot.PORTS):
+            if isinstance(values.get(port), bool): switches |= 1 << i
+        input_snapshot.PAYLOAD.pack_into(mem, input_snapshot.HEADER.size, switches,
+            *[ input_snapshot.MODES.index(modes.get(p)) if modes.get(p) in input_snapshot.MODES else 0
+               for p in input_snapshot.PORTS[:8] ],
+            *[ int(values.get(p) or 0) for p in input_snapshot.PORTS ],
+            *[ times.get(p, 0) for p in input_snapshot.PORTS ])
+        struct.pack_into("<Q", mem, 0, seq + 1)
+
+    # returns values, times and modes by port. None if no consistent
+    # snapshot could be read in time, e.g. because the owner died while
+    # writing it
+    def read(self):
+        mem = self.mem
+        deadline = time.monotonic() + SNAPSHOT_TIMEOUT
+        while True:
+            seq = input_snapshot.HEADER.unpack_from(mem)[0]
+            if not seq & 1:           # odd while being written right now
+                data = input_snapshot.PAYLOAD.unpack_from(mem, input_snapshot.HEADER.size)
+                if input_snapshot.HEADER.unpack_from(mem)[0] == seq: break
+            if time.monotonic() > deadline: return None
+
+        switches, modes, values, times = data[0], data[1:9], data[9:21], data[21:]
+        values = { p: bool(v) if switches & (1 << i) else v
+                   for i, (p, v) in enumerate(zip(input_snapshot.PORTS, values)) }
+        return (values, dict(zip(input_snapshot.PORTS, times)),
+                { p: input_snapshot.MODES[m] for p, m in zip(input_snapshot.PORTS, modes) })
+
+    def touch(self):
+        struct.pack_into("<d", self.mem, 8, time.monotonic())
+
+    def last_read(self):
+        return input_snapshot.HEADER.unpack_from(self.mem)[1]
+
+# connection to ftduinod which answers like the IoServer sketch
+class socket_port():
+    def __init__(self, path, timeout = 3):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    # returns whatever has arrived which may be more than size
+    def read(self, size = 1):
+        try:
+            data = self.sock.recv(max(size, 4096))
+        except socket.timeout:
+            return b""
+        if not data: raise OSError("ftduinod closed the connection")
+        return data
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes up the reader
+        except OSError:
+            pass
+        self.sock.close()
+        
+# backends open the connection to an ftDuino. The returned object needs
+# read(size), in_waiting, write(data) and close() like serial.Serial and
+# raises OSError once the connection is lost
+def serial_backend(device, baudrate):
+    # the device "sim" runs a simulated ftDuino instead
+    if device == "sim":
+        from fischertechnik.simulator import simulator
+        return simulator().open(device, baudrate)
+    # "unix:<path>" connects to ftduinod
+    if device.startswith("unix:"):
+        return socket_port(device[5:])
+    return serial.Serial(device, baudrate, timeout=3)
 
-        self.ftduino = None
-        self.input_values = { }
+# this in fact does not implement a TXT but an ftDuino ...
+class ftduino():
+    REPLY_TIMEOUT = 1   # seconds to wait for a reply from the ftDuino
+    FLUSH = object()    # tells the writer to send the pending port changes
     
-        if len(ports) == 0:
-            print("No ftDuino found");
-            self.ftduino = None
-            return
+    # device and baudrate default to the environment variables
+    # FTDUINO_DEVICE and FTDUINO_BAUDRATE. FTDUINO_DEVICE may be a comma
+    # separated list with one device per extension. Without a device the
+    # ftDuinos found on USB are used, the master being the one with the
+    # lowest serial number. If FTDUINO_SOCKET is set, the ftDuinos are
+    # used through the ftduinod listening there instead. A serial_number
+    # selects the ftDuino on USB regardless of its position
+    def __init__(self, ext = None, protocol = "binary", device = None, baudrate = None,
+                 backend = serial_backend, serial_number = None):
+        self.ext = ext or 0
+        self.backend = backend
+        self.serial_number = serial_number  # identifies our ftDuino when reconnecting
+        self.device = device or os.environ.get("FTDUINO_DEVICE")
+        self.socket = None if device else os.environ.get("FTDUINO_SOCKET")
+        self.baudrate = int(baudrate or os.environ.get("FTDUINO_BAUDRATE", FTDUINO_BAUDRATE))
+        self.protocol = protocol
+        
+        self.ftduino = None       # the serial port while connected
+        self.online = threading.Event()  # set once connected and set up
+        self.closed = False
+        self.connection_lock = threading.Lock()  # also guards sampler and cache
+        self.input_values = { }   # last values the ftDuino sent unrequested
+        self.inputs = { }         # snapshot of I1-I8 and C1-C4 by get_all_inputs()
+        self.input_times = { }    # time.monotonic() each snapshot value was taken
+        self.cache = { "hits": 0, "misses": 0 }
+        self.sampler = None
+        self.last_read = 0
+        self.version = None
+        self.subscriptions = { }  # port -> threshold of inputs pushed by the ftDuino
+        self.event_listeners = [ ]
+        self.sample_listeners = [ ]
+        self.snapshot = None      # shared by ftduinod
+        self.codec = json_framer()  # replaced when switching protocols
+
+        # requests waiting for a reply, one queue of futures per port
+        self.pending = { }
+        self.pending_lock = threading.Lock()
         
+        # all writes go through this queue into the writer thread
+        self.outbound = queue.SimpleQueue()
+
+        # state of O1-O8, M1-M4 and the input modes of I1-I8 as last set
+        # by the app. Changes not yet sent are collected in dirty
+        self.shadow = { }
+        self.dirty = { }
+        self.shadow_lock = threading.Lock()
+        self.coalesce_delay = COALESCE_DELAY
+        self.writes = { "requested": 0, "sent": 0 }
+
+        device = self.find_device()
+        if not device:
+            if self.ext: print("No ftDuino found for extension", self.ext);
+            else:        print("No ftDuino found");
+
+        if not device or not self.connect(device):
+            # keep looking, the ftDuino may be plugged in later
+            threading.Thread(target=self.reconnect, daemon=True).start()
+
+    def find_device(self):
+        if self.socket:
+            return "unix:" + socket_path(self.socket, self.ext)
+        
+        # a configured device takes precedence over searching USB
+        if self.device:
+            devices = self.device.split(",")
+            return devices[self.ext] if self.ext < len(devices) else None
+
+        ports = find_ftduinos()
+        if self.serial_number:
+            # after a reconnect only the very same ftDuino will do
+            for p in ports:
+                if p.serial_number == self.serial_number:
+                    return p.device
+            return None
+
+        if self.ext >= len(ports): return None
+        self.serial_number = ports[self.ext].serial_number
+        return ports[self.ext].device
+        
+    def connect(self, device):
         # try to connect ...
         try:
-            # The Serial object that the printer is communicating on.
-            self.ftduino = serial.Serial(ports[0], 19200, timeout=3)
-        except serial.serialutil.SerialException:
-            print("Error connecting to ftDuino");
-
+            port = self.backend(device, self.baudrate)
+        except (serial.serialutil.SerialException, OSError) as e:
+            print("Error connecting to ftDuino:", str(e));
+            return False
+
+        self.codec = json_framer()
+        self.outbound = queue.SimpleQueue()
+        self.inputs.clear()
+        self.input_times.clear()
+        self.ftduino = port
+        if device.startswith("unix:"):
+            self.snapshot = input_snapshot.open(snapshot_path(device[5:]))
+        
+        # the reader thread owns the receiving side of the serial port,
+        # the writer thread the sending side
+        threading.Thread(target=self.io_reader, args=(port,), daemon=True).start()
+        threading.Thread(target=self.io_writer, args=(port, self.outbound), daemon=True).start()
+
+        # resets the IoServer and brings it back into json mode, even if
+        # a previous connection stopped in the middle of a binary frame
+        self.outbound.put(binary_framer.RESET)
+        self.version = self.exchange("version", { "get": "version" })
+        if self.version == None:
+            # every IoServer tells its version. Also ftduinod doesn't
+            # while it has no ftDuino itself
+            print("ftDuino didn't answer")
+            with self.connection_lock:
+                self.ftduino = None
+            self.outbound.put(None)   # stop writer
+            port.close()
+            return False
+
+        if self.protocol == "binary":
+            self.negotiate_binary()
+
+        self.online.set()
+        self.restore()
+        return True
+    
+    def negotiate_binary(self):
+        # switch to the binary protocol if the IoServer supports it. Nothing
+        # else must be sent until the switch has been acknowledged
+        if self.version_at_least(BINARY_VERSION):
+            if self.exchange("protocol", { "set": "binary" }) == "binary":
+                print("Using binary protocol")
+
+    def restore(self):
+        # bring a freshly reset ftDuino into the state the app expects
+        with self.shadow_lock:
+            self.dirty = dict(self.shadow)
+        if self.dirty: self.outbound.put(ftduino.FLUSH)
+        
+        for port, threshold in self.subscriptions.items():
+            self.send({ "set": { "port": port, "subscribe": True, "threshold": threshold } })
+        
+    def disconnected(self, port):
+        with self.connection_lock:
+            if self.ftduino is not port: return
+            self.ftduino = None
+            self.online.clear()
+        
+        self.outbound.put(None)   # stop writer
+        try:
+            port.close()
+        except (serial.serialutil.SerialException, OSError):
+            pass
+
+        # nobody is going to answer the pending requests anymore
+        with self.pending_lock:
+            for waiting in self.pending.values():
+                for f in waiting: f.set_result(None)
+            self.pending.clear()
+
+        if not self.closed:
+            print("ftDuino lost, trying to reconnect")
+            threading.Thread(target=self.reconnect, daemon=True).start()
+
+    # also used when the first attempt to connect failed
+    def reconnect(self):
+        delay = RECONNECT_DELAY[0]
+        while not self.closed:
+            time.sleep(delay)
+            device = self.find_device()
+            if device and not self.closed and self.connect(device):
+                print("ftDuino connected")
+                # closed while connecting
+                if self.closed: self.disconnected(self.ftduino)
+                return
+            delay = min(2*delay, RECONNECT_DELAY[1])
+        
+    def close(self):
+        self.closed = True
+        if self.ftduino: self.disconnected(self.ftduino)
+        
     def get_loudspeaker(self):
         return loudspeaker()
             
     def set_o_value(self, port, val):
         val = (val * 255)//512        
-        cmd = { "set": { "port": "o"+str(port), "value": val, "mode": "high" } }
-        self.lock.acquire()
-        self.send(json.dumps(cmd))
-        self.lock.release()
+        self.set_port({ "port": "o"+str(port), "value": val, "mode": "high" })
 
     def set_m_value(self, port, val, mode):
         val = (val * 255)//512        
-        cmd = { "set": { "port": "m"+str(port), "value": val, "mode": mode } }
-        self.lock.acquire()
-        self.send(json.dumps(cmd))
-        self.lock.release()
+        self.set_port({ "port": "m"+str(port), "value": val, "mode": mode })
 
     def set_i_mode(self, port, mode):
-        cmd = { "set": { "port": "i"+str(port), "mode": mode } }
-        if "i"+str(port) in self.input_values:
-            self.input_values.pop("i"+str(port))  # clear any old value
-        self.lock.acquire()
-        self.send(json.dumps(cmd))        
-        self.lock.release()
-
-    def poll(self, port):
-        if not self.ftduino: return None
+        if self.set_port({ "port": "i"+str(port), "mode": mode }):
+            if "i"+str(port) in self.input_values:
+                self.input_values.pop("i"+str(port))  # clear any old value
+            self.inputs.pop("i"+str(port), None)
+            self.input_times.pop("i"+str(port), None)
+
+    # update the shadow state of a port and queue the change. Writes
+    # that don't change anything are dropped, several changes of the
+    # same port within coalesce_delay are merged into the last one
+    def set_port(self, state):
+        port = state["port"]
+        with self.shadow_lock:
+            self.writes["requested"] += 1
+            if self.shadow.get(port) == state:
+                return False
+            self.shadow[port] = state
+            wake = not self.dirty
+            self.dirty[port] = state
+
+        # while offline the change will be sent by restore()
+        if wake and self.online.is_set(): self.outbound.put(ftduino.FLUSH)
+        return True
+
+    def flush_ports(self):
+        with self.shadow_lock:
+            dirty, self.dirty = self.dirty, { }
+            self.writes["sent"] += len(dirty)
+
+        data = b""
+        for state in dirty.values():
+            try:
+                data += self.codec.encode({ "set": state })
+            except ValueError as e:
+                print(str(e))
+        return data
+
+    def io_reader(self, port):
+        try:
+            while self.ftduino is port:
+                # read everything that's available in one go
+                data = port.read(port.in_waiting or 1)
+                while data:
+                    frames = self.codec.feed(data)
+                    data = self.codec.rest   # left over after a protocol switch
+                    for msg in frames:
+                        self.dispatch(msg)
+        except (serial.serialutil.SerialException, OSError, TypeError) as e:
+            # pyserial raises TypeError if the port is closed while reading
+            if self.ftduino is port: print("ftDuino read failed:", str(e))
+
+        self.disconnected(port)
             
-        # read all available bytes from ftduino
-        r = [ 1 ]
-        msg = ""
-        while len(r):            
-            r, w, e = select.select([self.ftduino], [], [self.ftduino], 1)
-            if not self.ftduino in r:
-                print("Decoding timeout");
-                return None
-                
-            # append character
-            msg += self.ftduino.read().decode()
+    def io_writer(self, port, outbound):
+        while True:
+            chunks = [ outbound.get() ]
+
+            # give the app some time to change ports again before
+            # sending them
+            if chunks[0] is ftduino.FLUSH and self.coalesce_delay:
+                time.sleep(self.coalesce_delay)
+            
+            # collect everything that's queued up into one write. This
+            # thread is the only consumer, so get() won't block here
+            while not outbound.empty():
+                chunks.append(outbound.get())
+
+            data = b""
+            for chunk in chunks:
+                if chunk is None or self.ftduino is not port: return
+                if chunk is ftduino.FLUSH:
+                    try:
+                        chunk = self.flush_ports()
+                    except Exception as e:
+                        # a single bad frame must not stop all output
+                        print("Dropping port changes:", repr(e))
+                        continue
+                data += chunk
+            if not data: continue
             
-            # check for a full decodable message
             try:
-                msg = json.loads(msg)
-                if "port" in msg and "value" in msg and msg["port"].lower() == port:
-                    return msg["value"]
-                else:
-                    None  # decodable but not the info we were hoping for
-            except:
-                pass
-                
-        return None
+                port.write(data)
+            except (serial.serialutil.SerialException, OSError, TypeError) as e:
+                # TypeError again if the port is closed while writing
+                print("ftDuino write failed:", str(e))
+                self.disconnected(port)
+                return
+
+    def dispatch(self, msg):
+        if "event" in msg and "value" in msg:
+            # a subscribed input has changed
+            port = msg["event"].lower()
+            self.inputs[port] = msg["value"]
+            self.input_times[port] = time.monotonic()
+            for listener in self.event_listeners:
+                listener(port, msg["value"])
+            for listener in self.sample_listeners:
+                listener()
+            return
+        
+        if "port" in msg and "value" in msg:
+            key = msg["port"].lower()
+            value = msg["value"]
+        elif "version" in msg:
+            key, value = "version", msg["version"]
+        elif "protocol" in msg:
+            # the ftDuino has switched protocols, decode everything
+            # that follows accordingly
+            key, value = "protocol", msg["protocol"]
+            if value == "binary": self.codec = binary_framer()
+        elif "devices" in msg:
+            key, value = "devices", msg["devices"]
+        elif "inputs" in msg and "counters" in msg:
+            # reply to a "get all" request. This updates the snapshot
+            # even if nobody asked for it
+            key = "all"
+            value = { }
+            for i,v in enumerate(msg["inputs"]):   value["i"+str(i+1)] = v
+            for c,v in enumerate(msg["counters"]): value["c"+str(c+1)] = v
+            self.inputs.update(value)
+            now = time.monotonic()
+            for port in value: self.input_times[port] = now
+            for listener in self.sample_listeners:
+                listener()
+        else:
+            print("ftDuino error:", msg)
+            return
+
+        # hand value to the oldest request waiting for this port
+        with self.pending_lock:
+            waiting = self.pending.get(key)
+            f = waiting.popleft() if waiting else None
+
+        if f: f.set_result(value)
+        else: self.input_values[key] = value
+        
+    def request(self, key, cmd):
+        # requests of the app have to wait until the ftDuino is set up
+        if not self.online.is_set(): return None
+        return self.exchange(key, cmd)
+    
+    # send a request and return a future for its reply
+    def submit(self, key, cmd):
+        f = futures.Future()
+        with self.pending_lock:
+            self.pending.setdefault(key, deque()).append(f)
+        if not self.send(cmd):
+            with self.pending_lock: self.pending[key].remove(f)
+            return None
+        return f
+
+    def exchange(self, key, cmd):
+        return self.result(key, self.submit(key, cmd))
+
+    def result(self, key, f):
+        if not f: return None
+        try:
+            return f.result(ftduino.REPLY_TIMEOUT)
+        except futures.TimeoutError:
+            with self.pending_lock:
+                if f in self.pending.get(key, ()):
+                    self.pending[key].remove(f)
+            print("Decoding timeout");
+            return None
+        
+    def get_version(self):
+        return self.request("version", { "get": "version" })
+
+    def version_at_least(self, version):
+        try:
+            return tuple(int(v) for v in self.version.split(".")) >= version
+        except (AttributeError, ValueError):
+            return False
+        
+    def supports_push(self):
+        return self.version_at_least(PUSH_VERSION)
+
+    # ask the ftDuino to report changes of an input ("i1") or counter
+    # ("c1") by itself. Analog values are only reported when they change
+    # by more than the threshold, by default just enough to ignore the
+    # jitter of the inputs. Returns False if the ftDuino cannot do this
+    def subscribe(self, port, threshold = None):
+        if not self.supports_push():
+            return False
+        if threshold == None: threshold = push_threshold(port)
+
+        # subscriptions are renewed by restore() after reconnecting
+        self.subscriptions[port] = threshold
+        if self.online.is_set():
+            self.send({ "set": { "port": port, "subscribe": True, "threshold": threshold } })
+        return True
+
+    def unsubscribe(self, port):
+        if self.subscriptions.pop(port, None) != None:
+            cmd = { "set": { "port": port, "subscribe": False } }
+            self.send(cmd)
+    
+    # listeners are called from the reader thread and must not block
+    def add_event_listener(self, listener):
+        self.event_listeners.append(listener)
+
+    # called without arguments whenever inputs or inputs_times were
+    # updated. Same rules as for event listeners
+    def add_sample_listener(self, listener):
+        self.sample_listeners.append(listener)
+        
+    def supports_get_all(self):
+        return self.version_at_least(ALL_VERSION)
+
+    def get_all_inputs(self):
+        # older IoServers have to be asked port by port
+        if not self.supports_get_all():
+            if self.get_ports(ALL_PORTS) == None:
+                return None
+            return self.inputs
+
+        # fetch all inputs and counters in one single round trip
+        if self.request("all", { "get": "all" }) == None:
+            return None
+        return self.inputs
+
+    # read single inputs ("i1") and counters ("c1") into the snapshot
+    # the way IoServers before "get all" need it. All requests are sent
+    # at once and the replies collected afterwards
+    def get_ports(self, ports):
+        if not self.online.is_set(): return None
+        requests = [ (port, self.submit(port, { "get": { "port": port, "type": "counter" } } if port[0] == "c"
+                                           else { "get": { "port": port } })) for port in ports ]
+        values = { }
+        for port, f in requests:
+            value = self.result(port, f)
+            if value == None: return None
+            # analog values come as strings
+            values[port] = int(value) if isinstance(value, str) and value.isdigit() else value
+
+        self.inputs.update(values)
+        now = time.monotonic()
+        for port in values: self.input_times[port] = now
+        for listener in self.sample_listeners:
+            listener()
+        return values
+
+    # return the value of an input ("i1") or counter ("c1") from the
+    # snapshot if it's not older than max_age seconds. Otherwise read it
+    # from the ftDuino. A background sampler keeps the snapshot fresh
+    # as long as the app keeps reading
+    def get_input(self, port, max_age):
+        now = time.monotonic()
+        with self.connection_lock:
+            self.last_read = now
+
+        # ftduinod samples for us as long as we keep reading
+        if self.snapshot and self.online.is_set():
+            self.snapshot.touch()
+            snapshot = self.snapshot.read()
+            if snapshot and now - snapshot[1][port] <= max_age:
+                self.count("hits")
+                return snapshot[0][port]
+        elif self.online.is_set() and self.supports_get_all():
+            # sampling port by port would just clog the link
+            with self.connection_lock:
+                if not self.sampler:
+                    self.sampler = threading.Thread(target=self.input_sampler, daemon=True)
+                    self.sampler.start()
+
+        # subscribed ports are pushed by the ftDuino and thus always current
+        if port in self.input_times and (now - self.input_times[port] <= max_age or
+                                         (port in self.subscriptions and self.online.is_set())):
+            self.count("hits")
+        else:
+            self.count("misses")
+            if self.supports_get_all():
+                if self.get_all_inputs() == None:
+                    return None
+            elif self.get_ports([ port ]) == None:
+                return None
+        return self.inputs.get(port)
+
+    def count(self, what):
+        with self.connection_lock:
+            self.cache[what] += 1
+
+    # return all inputs and counters, none older than max_age seconds
+    def get_inputs(self, max_age):
+        if self.snapshot and self.online.is_set():
+            self.snapshot.touch()
+            snapshot = self.snapshot.read()
+            if snapshot and time.monotonic() - min(snapshot[1].values()) <= max_age:
+                return snapshot[0]
+        return self.get_all_inputs()
+        
+    def input_sampler(self):
+        while True:
+            # decide to stop and say so in one step, so a reader can't
+            # rely on a sampler that is just going away
+            with self.connection_lock:
+                if not self.online.is_set() or time.monotonic() - self.last_read >= SAMPLE_IDLE:
+                    self.sampler = None
+                    return
+            self.get_all_inputs()
+            time.sleep(SAMPLE_INTERVAL)
+        
+    # request all inputs without waiting for the reply. This allows
+    # to poll several ftDuinos in parallel. None if the ftDuino can't
+    # answer "get all"
+    def submit_all_inputs(self):
+        if not self.online.is_set() or not self.supports_get_all(): return None
+        return self.submit("all", { "get": "all" })
         
     def get_i_value(self, port):
         port = "i"+str(port)        
         cmd = { "get": { "port": port } }
-        self.lock.acquire()
-        self.send(json.dumps(cmd))
-        val = self.poll(port);
-        self.lock.release()
-        return val
+        return self.request(port, cmd)
         
     def send(self, cmd):
-        if self.ftduino:
-            self.ftduino.write(cmd.encode())
+        if not self.ftduino: return False
+        try:
+            self.outbound.put(self.codec.encode(cmd))
+        except ValueError as e:
+            print(str(e))
+            return False
+        return True
 
 ####################### CONTROLLER FACTORY ####################
 def init_controller_factory():
     pass
 
 class controller_factory():
+    controllers = { }  # one ftduino per extension index
+    lock = threading.Lock()
+    
     def create_graphical_controller(ext = None):
-        return ftduino(ext)
+        ext = ext or 0
+        with controller_factory.lock:
+            if not ext in controller_factory.controllers:
+                controller_factory.controllers[ext] = ftduino(ext)
+            return controller_factory.controllers[ext]
 
 ########## root device inherited by all device types ##########
     
@@ -260,20 +1055,43 @@ def init_input_factory():
 class input(device):
     thread = None  # single global thread for all inputs
     handler = [ ]
+    events = queue.SimpleQueue()  # wakes the monitor on pushed changes
+    threshold = PUSH_THRESHOLD  # minimum change of analog values to be pushed
+    max_age = .05  # maximum age in seconds of a cached input value
     
     def get_value(self):
-        return self.controller.get_i_value(self.port)
+        return self.controller.get_input("i"+str(self.port), self.max_age)
     
     def input_monitor(self):
+        next_poll = 0
         while True:
-            # poll inputs
+            # poll inputs of all controllers that can't push changes
+            polled = set(h["obj"].controller for h in input.handler if not h["push"])
+            if polled and time.monotonic() >= next_poll:
+                # all ftDuinos are polled in parallel. Those that can't
+                # answer "get all" just for the inputs handlers watch
+                for c, f in [ (c, c.submit_all_inputs()) for c in polled ]:
+                    if f: c.result("all", f)
+                    elif c.online.is_set():
+                        c.get_ports(sorted(set("i"+str(h["obj"].port) for h in input.handler
+                                               if h["obj"].controller is c)))
+                next_poll = time.monotonic() + POLL_DELAY
+
             for h in input.handler:
-                value = self.controller.get_i_value(h["obj"].port)
+                value = h["obj"].controller.inputs.get("i"+str(h["obj"].port))
                 if value != None and value != h["value"]:
                     h["value"] = value
                     h["handler"](value)
-                    
-            time.sleep(POLL_DELAY)
+
+            # sleep until something was pushed or the next poll is due
+            try:
+                if polled: input.events.get(True, max(0, next_poll - time.monotonic()))
+                else:      input.events.get()
+            except queue.Empty:
+                pass
+
+    def on_event(port, value):
+        input.events.put(port)
         
     def add_change_listener(self, ref, callback):
         print("ref", ref)
@@ -282,9 +1100,15 @@ class input(device):
             input.thread = threading.Thread(target=self.input_monitor, daemon=True)
             input.thread.start()
 
+        # let the ftDuino report changes itself if it can
+        if not input.on_event in self.controller.event_listeners:
+            self.controller.add_event_listener(input.on_event)
+        push = self.controller.subscribe("i"+str(self.port), self.threshold)
+            
         # store listener in handler list
         input.handler.append( { "obj": self, "ref": ref, "handler": callback,
-                                "value": self.controller.get_i_value(self.port) } )
+                                "value": self.get_value(), "push": push } )
+        input.events.put(None)
             
 class input_state(input):
     def __init__(self, controller, port):
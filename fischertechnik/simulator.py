@@ -0,0 +1,340 @@
+#
+# simulator.py - hardware free ftDuino running the IoServer sketch
+#
+# The simulator speaks the same json protocol as IoServer/JsonParser.cpp
+# and can be used as a backend of factories.ftduino, either by setting
+# FTDUINO_DEVICE=sim or explicitly:
+#
+#   sim = simulator(latency = .002, baudrate = 115200)
+#   sim.script("i1", [ (0, False), (.5, True), (1, False) ])
+#   controller = ftduino(device = "sim", backend = sim.open)
+#
+# All timing is derived from a clock which can be replaced for fully
+# deterministic runs. Replies become readable once the per command
+# latency plus the time to transfer all bytes over the modelled serial
+# link have passed. Only the read timeout is real time, so a read
+# returns even if the clock stands still.
+
+import threading, time, json, re
+
+from fischertechnik.factories import json_framer
+
+# IoServer error codes
+ERR_UNK_CMD     = 10  # unknown command
+ERR_UNK_PARM    = 11  # unknown parameter
+ERR_WRONG_VTYPE = 12  # wrong value type
+ERR_ILL_PORT    = 13  # illegal port specification
+ERR_ILL_MODE    = 14  # illegal mode specification
+ERR_ILL_REQ     = 17  # illegal get request
+ERR_INC_I2C     = 19  # incomplete i2c request
+
+I2C_NACK = 2  # Wire.endTransmission() result for an unanswered address
+SUB_THRESHOLD = 10  # threshold of inputs subscribed without one
+
+INPUT_MODES = ( "voltage", "resistance", "switch" )
+OUTPUT_MODES = ( "high", "low", "open", "off" )
+MOTOR_MODES = ( "left", "right", "brake", "open", "off" )
+PARMS = ( "port", "value", "mode", "type", "addr", "reg", "len", "subscribe", "threshold" )
+
+class simulator():
+    # latency is either the delay of every reply in seconds or a
+    # dict with the delay per request ("get", "set", "all", "version",
+    # "devices", "i2c"). A baudrate of None models an infinitely fast link
+    def __init__(self, latency = 0, baudrate = None, clock = None, version = "0.9.4"):
+        self.latency = latency
+        self.baudrate = baudrate
+        self.clock = clock or time.monotonic
+        self.version = version
+        self.start = self.clock()
+
+        self.inputs = [ 0 ] * 8           # values of unscripted inputs
+        self.counter_levels = [ False ] * 4
+        self.i2c = { }                    # addr -> bytearray of registers
+        self.scripts = { }                # port -> waveform
+        self.commands = 0                 # number of commands processed
+        self.lock = threading.Lock()
+        self.reset()
+
+    # state as set up by JsonParser::reset()
+    def reset(self):
+        self.input_modes = [ "resistance" ] * 8
+        self.counters = [ 0 ] * 4
+        self.outputs = [ ("off", 0) ] * 8
+        self.motors = [ ("off", 0) ] * 4
+        self.led = False
+        self.subscribed = { }             # index (0-7: I1-I8, 8-11: C1-C4) -> threshold
+        self.reported = { }               # index -> last value sent
+
+    # a waveform is either a function of the time since start or a list
+    # of (time, value) steps. Counter inputs ("c1") are scripted by their
+    # level, every falling edge is counted
+    def script(self, port, waveform):
+        with self.lock:
+            self.scripts[port.lower()] = waveform
+
+    def level(self, port, t):
+        waveform = self.scripts[port]
+        if callable(waveform): return waveform(t)
+        value = None
+        for step, v in waveform:
+            if step > t: break
+            value = v
+        return value
+
+    def version_at_least(self, version):
+        return tuple(int(v) for v in self.version.split(".")) >= version
+
+    def now(self):
+        return self.clock() - self.start
+
+    def input_value(self, i, t):
+        v = self.level("i"+str(i+1), t) if "i"+str(i+1) in self.scripts else self.inputs[i]
+        if self.input_modes[i] == "switch": return bool(v)
+        return int(v)
+
+    def update_counters(self, t):
+        for c in range(4):
+            port = "c"+str(c+1)
+            if not port in self.scripts: continue
+            level = bool(self.level(port, t))
+            if self.counter_levels[c] and not level:
+                self.counters[c] += 1
+            self.counter_levels[c] = level
+
+    def open(self, device = None, baudrate = None):
+        return simulated_port(self)
+
+    # process one decoded json command, return the reply text
+    def process(self, cmd):
+        self.commands += 1
+        t = self.now()
+        self.update_counters(t)
+
+        if len(cmd) != 1:
+            return self.error(ERR_UNK_CMD), "set"
+        name, parms = list(cmd.items())[0]
+        name = name.lower()
+        if name == "get": return self.process_get(parms, t)
+        if name == "set": return self.process_set(parms), "set"
+        return self.error(ERR_UNK_CMD), "set"
+
+    def process_get(self, parms, t):
+        if isinstance(parms, str):
+            req = parms.lower()
+            if req.startswith("devices"):
+                return '{ "devices": { "name": "ftDuino", "id": 0, "io": true } }', "devices"
+            if req.startswith("version"):
+                return '{ "version": "' + self.version + '" }', "version"
+            if req.startswith("all") and self.version_at_least((0, 9, 3)):
+                inputs = [ self.input_value(i, t) for i in range(8) ]
+                return ('{ "inputs": [ ' + ", ".join(json.dumps(v) for v in inputs) +
+                        ' ], "counters": [ ' + ", ".join(str(c) for c in self.counters) +
+                        ' ] }'), "all"
+            return self.error(ERR_ILL_REQ), "get"
+
+        if not isinstance(parms, dict):
+            return self.error(ERR_WRONG_VTYPE), "get"
+        for p in parms:
+            if not p.lower() in PARMS: return self.error(ERR_UNK_PARM), "get"
+
+        port = str(parms.get("port", "")).lower()
+        if port == "i2c":
+            return self.process_i2c(parms, None), "i2c"
+
+        index = self.port_index(port, "ic")
+        if index == None:
+            return self.error(ERR_ILL_PORT), "get"
+        if port[0] == "i":
+            return self.reply_value("I", index, self.input_value(index, t)), "get"
+        if parms.get("type") == "counter":
+            return self.reply_value("C", index, self.counters[index], False), "get"
+        return self.reply_value("C", index, self.counter_levels[index], True), "get"
+
+    def process_set(self, parms):
+        if not isinstance(parms, dict):
+            return self.error(ERR_ILL_REQ)
+        for p in parms:
+            if not p.lower() in PARMS: return self.error(ERR_UNK_PARM)
+
+        port = str(parms.get("port", "")).lower()
+        mode = parms.get("mode")
+        value = parms.get("value")
+        if isinstance(value, bool): value = 255 if value else 0
+
+        if port == "i2c":
+            return self.process_i2c(parms, value)
+        if port.startswith("led"):
+            if value != None: self.led = bool(value)
+            return None
+
+        index = self.port_index(port, "iocm")
+        if index == None:
+            return self.error(ERR_ILL_PORT)
+
+        if port[0] == "o":
+            if mode != None and not mode in OUTPUT_MODES: return self.error(ERR_ILL_MODE)
+            old_mode, old_value = self.outputs[index]
+            self.outputs[index] = (mode or old_mode, old_value if value == None else value)
+        elif port[0] == "m":
+            if mode != None and not mode in MOTOR_MODES: return self.error(ERR_ILL_MODE)
+            old_mode, old_value = self.motors[index]
+            self.motors[index] = (mode or old_mode, old_value if value == None else value)
+        elif port[0] == "i":
+            if mode != None:
+                if not mode in INPUT_MODES: return self.error(ERR_ILL_MODE)
+                self.input_modes[index] = mode
+                self.reported.pop(index, None)
+        elif not "subscribe" in parms:
+            self.counters[index] = 0
+
+        if "subscribe" in parms and port[0] in "ic":
+            if port[0] == "c": index += 8
+            if parms["subscribe"]:
+                self.subscribed[index] = parms.get("threshold", SUB_THRESHOLD if index < 8 else 0)
+                self.reported.pop(index, None)
+            else:
+                self.subscribed.pop(index, None)
+        return None
+
+    def process_i2c(self, parms, value):
+        addr = parms.get("addr")
+        if addr == None or (value == None and parms.get("len") == None):
+            return self.error(ERR_INC_I2C)
+        if not addr in self.i2c:
+            return '{ "port": "i2c", "value": "' + str(I2C_NACK) + '" }'
+
+        regs = self.i2c[addr]
+        reg = parms.get("reg", 0)
+        if value != None:
+            for i,v in enumerate(value if isinstance(value, list) else [ value ]):
+                regs[(reg + i) % len(regs)] = v & 0xff
+            return '{ "port": "i2c", "value": "0" }'
+
+        data = [ regs[(reg + i) % len(regs)] for i in range(parms["len"]) ]
+        return '{ "port": "i2c", "value": "0", "data": ' + json.dumps(data) + ' }'
+
+    # report changed subscribed inputs and counters like JsonParser::poll()
+    def poll(self):
+        if not self.subscribed: return ""
+        t = self.now()
+        self.update_counters(t)
+
+        events = ""
+        for index, threshold in self.subscribed.items():
+            if index < 8:
+                value = self.input_value(index, t)
+                name = "I"+str(index+1)
+            else:
+                value = self.counters[index-8]
+                name = "C"+str(index-7)
+
+            if index in self.reported:
+                diff = abs(int(value) - int(self.reported[index]))
+                if not diff or (not isinstance(value, bool) and diff <= threshold):
+                    continue
+            self.reported[index] = value
+            events += '{ "event": "' + name + '", "value": ' + json.dumps(value) + ' }'
+        return events
+
+    def port_index(self, port, types):
+        limits = { "i": 8, "o": 8, "c": 4, "m": 4 }
+        if len(port) != 2 or not port[0] in types or not port[1].isdigit():
+            return None
+        index = int(port[1]) - 1
+        return index if 0 <= index < limits[port[0]] else None
+
+    def reply_value(self, prefix, index, value, b = None):
+        if b == None: b = isinstance(value, bool)
+        value = ("true" if value else "false") if b else '"' + str(value) + '"'
+        return '{ "port": "' + prefix + str(index+1) + '", "value": ' + value + ' }'
+
+    def error(self, code):
+        return '{ "error": ' + str(code) + ' }'
+
+    def delay(self, request, nbytes):
+        latency = self.latency.get(request, 0) if isinstance(self.latency, dict) else self.latency
+        if self.baudrate: latency += nbytes * 10 / self.baudrate
+        return latency
+
+# the serial port side of the simulator as used by ftduino
+class simulated_port():
+    EVENT_INTERVAL = .001  # how often subscribed inputs are checked while reading
+
+    def __init__(self, sim, timeout = 3):
+        self.sim = sim
+        self.timeout = timeout
+        self.framer = json_framer()
+        self.replies = [ ]     # (time readable, bytes) in order
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def check_open(self):
+        if self.closed: raise OSError("simulated ftDuino closed")
+
+    @property
+    def in_waiting(self):
+        self.check_open()
+        with self.cond:
+            self.collect_events()
+            now = self.sim.now()
+            return sum(len(data) for t, data in self.replies if t <= now)
+
+    def collect_events(self):
+        with self.sim.lock:
+            events = self.sim.poll()
+        if events:
+            self.schedule(events.encode(), "event")
+
+    def schedule(self, data, request):
+        # replies never overtake each other
+        t = self.sim.now() + self.sim.delay(request, len(data))
+        if self.replies: t = max(t, self.replies[-1][0])
+        self.replies.append((t, data))
+        self.cond.notify_all()
+
+    def read(self, size = 1):
+        deadline = time.monotonic() + self.timeout
+        with self.cond:
+            while True:
+                self.check_open()
+                self.collect_events()
+                now = self.sim.now()
+                data = b""
+                while self.replies and self.replies[0][0] <= now and len(data) < size:
+                    t, chunk = self.replies[0]
+                    take = size - len(data)
+                    data += chunk[:take]
+                    if len(chunk) > take: self.replies[0] = (t, chunk[take:])
+                    else:                 self.replies.pop(0)
+                if data: return data
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: return b""
+
+                # wait for the next reply to become readable or for a
+                # write. Changes of subscribed inputs nobody tells us about
+                wait = remaining
+                if self.replies: wait = min(wait, max(0, self.replies[0][0] - now))
+                if self.sim.subscribed: wait = min(wait, self.EVENT_INTERVAL)
+                self.cond.wait(wait)
+
+    def write(self, data):
+        self.check_open()
+        with self.cond:
+            # a null-byte or ESC resets the IoServer
+            for i, part in enumerate(re.split(rb"[\x00\x1b]", data)):
+                if i:
+                    self.framer.reset()
+                    with self.sim.lock: self.sim.reset()
+                    
+                for cmd in self.framer.feed(part):
+                    with self.sim.lock:
+                        reply, request = self.sim.process(cmd)
+                    if reply: self.schedule(reply.encode(), request)
+            # a new subscription has to be polled right away
+            self.cond.notify_all()
+        return len(data)
+
+    def close(self):
+        self.closed = True
+        with self.cond:
+            self.cond.notify_all()
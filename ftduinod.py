@@ -0,0 +1,319 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# ftduinod.py
+#
+# This daemon owns the ftDuinos and shares them between the server
+# and the apps. Clients connect to a Unix socket and talk the json
+# protocol of the IoServer sketch as if they were connected to the
+# ftDuino itself. factories.ftduino does so when FTDUINO_SOCKET is
+# set. The connection to the ftDuino stays up between app runs.
+# Outputs an app has left running are switched off once it
+# disconnects, input modes are kept.
+#
+# Extensions are served on the socket path with the extension index
+# appended (see factories.socket_path). ftDuinos plugged in later are
+# picked up as further extensions. Next to every socket the last
+# sample of all inputs and counters is shared through memory (see
+# factories.input_snapshot). The ftDuino is sampled as long as
+# somebody reads it.
+#
+# python3 ftduinod.py [-s socket]
+
+import argparse, json, os, queue, re, signal, socket, socketserver, sys, threading, time
+
+from fischertechnik.factories import ftduino, json_framer, find_ftduinos, input_snapshot
+from fischertechnik.factories import socket_path, snapshot_path, SAMPLE_INTERVAL, SAMPLE_IDLE, POLL_DELAY
+from fischertechnik.factories import ALL_PORTS, push_threshold
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "ftduinod.sock")
+HOTPLUG_INTERVAL = 2   # seconds between checks for newly attached ftDuinos
+SESSION_BACKLOG = 65536  # bytes queued for a client before it is dropped
+VERSION_WAIT = .5      # seconds a version request waits for the ftDuino to connect
+
+# IoServer error codes
+ERR_UNK_CMD = 10  # unknown command
+ERR_ILL_REQ = 17  # illegal get request
+ERR_OFFLINE = 100 # the ftDuino isn't connected (ftduinod only)
+
+# one connected client. Everything sent to it goes through its own
+# writer thread, so a client that doesn't read can't hold up the others
+class session(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.lock = threading.Lock()   # replies and events come from different threads
+        self.outbound = queue.SimpleQueue()
+        self.queued = 0                # bytes waiting in outbound
+        self.dropped = False
+        self.framer = json_framer()
+        self.subscriptions = set()
+        self.outputs = set()           # outputs and motors set by this client
+        threading.Thread(target=self.writer, daemon=True).start()
+
+    # never blocks. A client that has fallen too far behind is dropped
+    def reply(self, text):
+        data = text.encode()
+        with self.lock:
+            if self.dropped: return
+            self.queued += len(data)
+            self.dropped = self.queued > SESSION_BACKLOG
+            if not self.dropped:
+                self.outbound.put(data)
+                return
+        print("Dropping client that doesn't read its replies")
+        self.drop()
+
+    # ends handle(), which then closes the session
+    def drop(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def writer(self):
+        while True:
+            data = self.outbound.get()
+            if data is None: return
+            with self.lock:
+                self.queued -= len(data)
+            try:
+                self.request.sendall(data)
+            except OSError:
+                self.drop()
+                return
+
+    def finish(self):
+        self.outbound.put(None)
+
+    def handle(self):
+        owner = self.server.owner
+        owner.sessions.add(self)
+        try:
+            while True:
+                data = self.request.recv(4096)
+                if not data: break
+
+                # a null-byte or ESC resets the client's parser
+                for i, part in enumerate(re.split(rb"[\x00\x1b]", data)):
+                    if i: self.framer.reset()
+                    for cmd in self.framer.feed(part):
+                        reply = owner.process(self, cmd)
+                        if reply: self.reply(reply)
+        except OSError:
+            pass
+        finally:
+            owner.close_session(self)
+
+# answers requests of all sessions of one ftDuino
+class owner():
+    def __init__(self, controller, snapshot = None):
+        self.controller = controller
+        self.sessions = set()
+        self.lock = threading.Lock()
+        controller.add_event_listener(self.on_event)
+
+        self.snapshot = snapshot
+        if snapshot:
+            controller.add_sample_listener(self.on_sample)
+            threading.Thread(target=self.sampler, daemon=True).start()
+
+    def on_sample(self):
+        modes = { p: s.get("mode") for p, s in list(self.controller.shadow.items()) if p[0] == "i" }
+        self.snapshot.write(self.controller.inputs, self.controller.input_times, modes)
+
+    # keep the snapshot fresh while clients read it
+    def sampler(self):
+        while True:
+            if time.monotonic() - self.snapshot.last_read() < SAMPLE_IDLE:
+                self.controller.get_all_inputs()
+                time.sleep(SAMPLE_INTERVAL)
+            else:
+                time.sleep(POLL_DELAY)
+
+    def error(self, code):
+        return '{ "error": ' + str(code) + ' }'
+
+    def process(self, session, cmd):
+        if len(cmd) != 1:
+            return self.error(ERR_UNK_CMD)
+        name, parms = list(cmd.items())[0]
+        name = name.lower()
+        if name == "get": return self.process_get(cmd, parms)
+        if name == "set": return self.process_set(session, cmd, parms)
+        return self.error(ERR_UNK_CMD)
+
+    def process_get(self, cmd, parms):
+        if isinstance(parms, str):
+            req = parms.lower()
+            if req.startswith("version"):
+                # clients keep the version, don't tell them there is none
+                if not self.controller.online.wait(VERSION_WAIT):
+                    return self.error(ERR_OFFLINE)
+                return json.dumps({ "version": self.controller.version })
+            if req.startswith("all"):
+                return self.all_inputs()
+            if req.startswith("devices"):
+                return json.dumps({ "devices": self.controller.request("devices", cmd) })
+            return self.error(ERR_ILL_REQ)
+
+        if not isinstance(parms, dict):
+            return self.error(ERR_ILL_REQ)
+
+        # offline ports are answered with null right away
+        port = str(parms.get("port", "")).lower()
+        value = self.controller.request(port, cmd)
+        return json.dumps({ "port": port if port == "i2c" else port.upper(), "value": value })
+
+    def process_set(self, session, cmd, parms):
+        # the clients stay with json, the socket is fast enough
+        if isinstance(parms, str) and parms.lower() == "binary":
+            return json.dumps({ "protocol": "json" })
+        if not isinstance(parms, dict):
+            return self.error(ERR_ILL_REQ)
+
+        port = str(parms.get("port", "")).lower()
+        if "subscribe" in parms:
+            self.subscribe(session, port, parms)
+        elif port[:1] in "om" and len(port) == 2:
+            # goes through the shadow state, so several clients
+            # setting the same value cause a single write
+            self.controller.set_port(dict(parms))
+            session.outputs.add(port)
+        elif port[:1] == "i" and port != "i2c" and "mode" in parms:
+            self.controller.set_i_mode(port[1:], parms["mode"])
+        elif port == "i2c":
+            value = self.controller.request(port, cmd)
+            return json.dumps({ "port": port, "value": value })
+        else:
+            # counter resets and the led
+            self.controller.send(cmd)
+        return None
+
+    def subscribe(self, session, port, parms):
+        with self.lock:
+            if parms["subscribe"]:
+                session.subscriptions.add(port)
+                threshold = parms.get("threshold", push_threshold(port))
+                if self.controller.subscriptions.get(port) != threshold:
+                    # the last subscriber's threshold applies. The ftDuino
+                    # reports the current value to everybody
+                    self.controller.subscribe(port, threshold)
+                elif port in self.controller.inputs:
+                    # already subscribed, start with the last value
+                    session.reply(self.event(port, self.controller.inputs[port]))
+            else:
+                session.subscriptions.discard(port)
+                if not any(port in s.subscriptions for s in list(self.sessions)):
+                    self.controller.unsubscribe(port)
+
+    def event(self, port, value):
+        return json.dumps({ "event": port.upper(), "value": value })
+
+    def on_event(self, port, value):
+        for session in list(self.sessions):
+            if port in session.subscriptions:
+                try:
+                    session.reply(self.event(port, value))
+                except OSError:
+                    pass   # the session will notice itself
+
+    def all_inputs(self):
+        # clients polling at the same time share one request. Not
+        # through get_input(), its sampler would poll on top of ours
+        now = time.monotonic()
+        times = self.controller.input_times
+        if any(now - times.get(p, 0) > SAMPLE_INTERVAL for p in ALL_PORTS):
+            if self.controller.get_all_inputs() == None:
+                return None
+        inputs = self.controller.inputs
+        return json.dumps({ "inputs": [ inputs.get("i"+str(i+1)) for i in range(8) ],
+                            "counters": [ inputs.get("c"+str(c+1)) for c in range(4) ] })
+
+    def close_session(self, session):
+        with self.lock:
+            self.sessions.discard(session)
+            for port in session.subscriptions:
+                if not any(port in s.subscriptions for s in list(self.sessions)):
+                    self.controller.unsubscribe(port)
+
+        # don't leave motors running after the app is gone
+        for port in session.outputs:
+            self.controller.set_port({ "port": port, "mode": "off", "value": 0 })
+
+class server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, owner):
+        self.owner = owner
+        super().__init__(path, session)
+
+def in_use(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+# the ftDuinos to serve next as (extension, serial number). Configured
+# devices are served in their order. Every ftDuino on USB not served
+# yet becomes the next extension, whatever its serial number. The
+# master is always served, it connects once it's plugged in
+def new_devices(servers):
+    devices = os.environ.get("FTDUINO_DEVICE")
+    if devices:
+        return [ (ext, None) for ext in range(len(servers), len(devices.split(","))) ]
+    if not servers:
+        return [ (0, None) ]
+
+    owned = set(s.owner.controller.serial_number for s in servers)
+    if None in owned:
+        return [ ]   # the master hasn't picked its ftDuino yet
+    ports = [ p for p in find_ftduinos() if not p.serial_number in owned ]
+    return [ (len(servers) + i, p.serial_number) for i, p in enumerate(ports) ]
+
+def start_server(path, ext, serial_number = None):
+    ext_path = socket_path(path, ext)
+    if os.path.exists(ext_path): os.unlink(ext_path)   # left over
+    snapshot = input_snapshot(snapshot_path(ext_path), create=True)
+    s = server(ext_path, owner(ftduino(ext, serial_number=serial_number), snapshot))
+    threading.Thread(target=s.serve_forever, daemon=True).start()
+    return s
+
+def run(path):
+    if in_use(path):
+        print("ftduinod is already running on", path)
+        sys.exit(1)
+
+    # we are the one talking to the ftDuinos
+    os.environ.pop("FTDUINO_SOCKET", None)
+
+    servers = [ ]
+    try:
+        while True:
+            devices = new_devices(servers)
+            while devices:
+                for ext, serial_number in devices:
+                    if ext: print("ftduinod serving extension", ext)
+                    servers.append(start_server(path, ext, serial_number))
+                    if not ext: print("ftduinod listening on", path)
+                devices = new_devices(servers)
+
+            if signal.sigtimedwait([ signal.SIGINT, signal.SIGTERM ], HOTPLUG_INTERVAL):
+                break
+    finally:
+        for s in servers:
+            s.owner.controller.close()
+            os.unlink(s.server_address)
+            os.unlink(snapshot_path(s.server_address))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share the ftDuinos between apps")
+    parser.add_argument("-s", "--socket", default=os.environ.get("FTDUINO_SOCKET", DEFAULT_SOCKET),
+                        help="Specify the socket to listen on")
+    args = parser.parse_args()
+
+    # handled by sigwait()
+    signal.pthread_sigmask(signal.SIG_BLOCK, [ signal.SIGINT, signal.SIGTERM ])
+    run(args.socket)
@@ -6,6 +6,12 @@
 # This program takes a txt project name as parameter and tries
 # to run it.
 #
+# Started with --warm it gets everything ready that doesn't depend on
+# the project and then waits for {"start": <project name>} on stdin.
+# The server may send the contents of the project's .project.json along
+# as "project".
+# The server keeps such a warm runner around to start apps quickly.
+#
 # Currently supported are:
 # - Display (interpret display.qml and run display.py)
 # - Controller
@@ -14,16 +20,15 @@
 #   - LED outputs
 # - Execution of main python code
 
-# TODO:
-# - use semaphore instead of queue
-#
-#
 
-from PyQt5.QtQml import QQmlApplicationEngine
-from PyQt5.QtWidgets import QApplication, QLabel
-from PyQt5.QtCore import QThread, QObject, QTimer, pyqtSignal, pyqtSlot
-import sys, os, time, queue, select
-import json, traceback
+from PyQt5.QtQml import QQmlApplicationEngine, QQmlComponent, QQmlEngine, QQmlExpression, QQmlProperty
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QColor
+from PyQt5.QtCore import QThread, QObject, QTimer, QUrl, QMetaType, QSocketNotifier, pyqtSignal
+import sys, os, select, threading
+from concurrent.futures import Future
+from functools import partial
+import json, traceback, re
 
 # fischertechnik seems to have placed their own custom
 # widgets in one of the standard modules which they import
@@ -33,6 +38,176 @@ import json, traceback
 import ftgui
 from fischertechnik.control.VoiceControl import VoiceControl
 
+# imported here so a warm runner has it ready. Without pyserial
+# only apps not using the controller can run
+try:
+    from fischertechnik.factories import controller_factory
+except ImportError:
+    controller_factory = None
+
+WARM = "--warm"
+
+# compiled by a warm runner to load the modules a display.qml uses
+WARMUP_QML = b"""import QtQuick 2.12
+import QtQuick.Controls 2.12
+import QtQuick.Window 2.0
+Item { }
+"""
+
+UNBOUND = object()    # result of reading what isn't a plain property
+FRAME_INTERVAL = 16   # ms between updates of the display by set_attr()
+STDIN_READ = 65536    # bytes of commands read from the server at once
+
+# javascript source of a value. RP-C converts everything to a string.
+# How do we know if it's actually a string?
+def script_value(value):
+    if value == "true" or value == "false":
+        return str(value)
+    return "\"" + value + "\""
+
+# convert a value sent by RP-C to the type of the property it's written to
+def property_value(value, type):
+    try:
+        if type == QMetaType.Bool:
+            return value != "false" and bool(value)
+        if type in ( QMetaType.Int, QMetaType.UInt, QMetaType.LongLong ):
+            return int(float(value))
+        if type in ( QMetaType.Double, QMetaType.Float ):
+            return float(value)
+    except (TypeError, ValueError):
+        pass
+    # QQmlProperty converts strings to colors, fonts etc itself
+    return value
+
+# typed access to the items of the display. An item is looked up by
+# its id once, its properties are then read and written through
+# QQmlProperty without compiling any javascript. Everything runs on
+# the gui thread, other threads go through call().
+#
+# Writes are collected and applied once per frame. Only the latest
+# value of every property is kept, nobody would see the others
+class QmlBinding(QObject):
+    doCall = pyqtSignal(object, object)
+
+    def __init__(self, window, script):
+        super().__init__()
+        self.window = window
+        self.context = QQmlEngine.contextForObject(window)
+        self.script = script       # runs what can't be done through a property
+        self.objects = { }         # id -> QObject or None
+        self.properties = { }      # "id.property" -> QQmlProperty or None
+        self.doCall.connect(self.on_call)
+
+        self.pending = { }         # "id.property" -> latest value
+        self.pending_lock = threading.Lock()
+        self.submitted = 0         # set_attr() calls
+        self.applied = 0           # writes that made it to the display
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    # run function on the gui thread and return its result. Called
+    # from the gui thread it runs right away
+    def call(self, function, wait = True):
+        future = Future() if wait else None
+        self.doCall.emit(function, future)
+        if future: return future.result()
+
+    def on_call(self, function, future):
+        try:
+            result = function()
+        except Exception as e:
+            # an exception escaping a slot would abort the app
+            if future: future.set_exception(e)
+            else:      print(traceback.format_exc())
+        else:
+            if future: future.set_result(result)
+
+    # look up all items of the display in one go instead of one by
+    # one as the app gets to them. The ids are taken from the source,
+    # ids not reachable from the window stay unknown
+    def index(self, qml):
+        with open(qml) as f:
+            ids = sorted(set(re.findall(r"\bid\s*:\s*([A-Za-z_]\w*)", f.read())))
+        if not ids:
+            return
+        
+        script = "[" + ", ".join("typeof {0} === 'undefined' ? null : {0}".format(i) for i in ids) + "]"
+        objects, undefined = QQmlExpression(self.context, self.window, script).evaluate()
+        if undefined or not hasattr(objects, "toVariant"):
+            return
+        for name, obj in zip(ids, objects.toVariant()):
+            if isinstance(obj, QObject): self.objects[name] = obj
+
+    def object(self, name):
+        if not name in self.objects:
+            obj = None
+            if name.isidentifier():
+                obj, undefined = QQmlExpression(self.context, self.window, name).evaluate()
+            self.objects[name] = obj if isinstance(obj, QObject) else None
+        return self.objects[name]
+
+    def property(self, item):
+        if not item in self.properties:
+            name, _, path = item.partition(".")
+            obj = self.object(name) if path else None
+            prop = QQmlProperty(obj, path) if obj else None
+            self.properties[item] = prop if prop and prop.isValid() else None
+        return self.properties[item]
+
+    # may be called from any thread
+    def submit(self, item, value):
+        with self.pending_lock:
+            self.submitted += 1
+            first = not self.pending
+            # keep the order of the writes
+            self.pending.pop(item, None)
+            self.pending[item] = value
+        if first:
+            self.call(partial(self.timer.start, FRAME_INTERVAL), wait=False)
+
+    def flush(self):
+        with self.pending_lock:
+            pending = self.pending
+            self.pending = { }
+            self.applied += len(pending)
+        for item, value in pending.items():
+            self.write(item, value)
+
+    def write(self, item, value):
+        prop = self.property(item)
+        if prop:
+            prop.write(property_value(value, prop.propertyType()))
+        else:
+            self.script(item + "= " + script_value(value))
+
+    # values are returned the way the qml side would have converted
+    # them to a string
+    def read(self, item):
+        # the app expects to read what it has just written
+        self.flush()
+        prop = self.property(item)
+        value = prop.read() if prop else None
+        if isinstance(value, bool) or isinstance(value, str):
+            return value
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        if isinstance(value, ( int, float )):
+            return str(value)
+        if isinstance(value, QColor):
+            return value.name()
+        return UNBOUND
+
+    # route the events of an item to slot
+    def connect(self, name, slot):
+        obj = self.object(name)
+        if not obj:
+            print("No such item:", name)
+            return
+        # the events carry the object name, so tell where they come from
+        obj.setObjectName(name)
+        obj.onEvent.connect(slot)
+
 class AppRunnerThread(QThread):
     finished = pyqtSignal()
     
@@ -49,13 +224,15 @@ class AppRunnerThread(QThread):
         if self.code:
             try:
                 exec(self.code, {})
-            except Exception as e:
+            except Exception:
                 print(traceback.format_exc())
         
         self.finished.emit()
             
 class RunApplication(QApplication):
-    doExecScript = pyqtSignal(str, bool)
+    # script and request id. Results of scripts with an id other than 0
+    # are sent back with it
+    doExecScript = pyqtSignal(str, int)
 
     # handle user triggered gui events (e.g. "Wenn Schieberegler bewegt)"
     def handler(self, eid, parm):
@@ -79,48 +256,56 @@ class RunApplication(QApplication):
             print("No such handler:", eid)
             
     def install_handler(self, id, event, handler):
-        # set object name, so it's addressable from the python side
-        self.doExecScript.emit(id+".objectName = \""+id+"\"", False);
-        # it may take some time for this to show effect
-        obj = None
-        while not obj: obj = self.engine.rootObjects()[0].findChild(QObject, id)
+        if not self.binding:
+            print("No display for handler:", id)
+            return
 
         self.handlers[id+":"+event] = handler
-        obj.onEvent.connect(self.handler)        
+        self.binding.call(partial(self.binding.connect, id, self.handler))
         
     def execScript(self, code):
-        self.doExecScript.emit(code, False)
+        self.doExecScript.emit(code, 0)
 
     # this is also new
     def set_attr(self, item, value):
-        # RP-C converts everything to a string. How do we know if it's
-        # actually a string?        
-        if value == "true" or value == "false":
-            self.doExecScript.emit(item + "= "+str(value)+"", False);
-        else:
-            self.doExecScript.emit(item + "= \""+value+"\"", False);
+        if self.binding:
+            self.binding.submit(item, value)
 
     def get_attr(self, item):
-        # simply invoke attribute name. This will return its value
-        self.doExecScript.emit(item, True);
+        if not self.binding:
+            return None
 
-        # wait for result
-        while self.queue.empty(): pass
+        value = self.binding.call(partial(self.binding.read, item))
+        if value is not UNBOUND:
+            return value
 
-        # return result
-        return self.queue.get()
+        # anything else is evaluated by the qml side
+        # every request gets its own id, so app threads asking at the
+        # same time don't get each other's results
+        with self.requests_lock:
+            self.request_id += 1
+            request = self.request_id
+            future = self.requests[request] = Future()
+            
+        # simply invoke attribute name. This will return its value
+        self.doExecScript.emit(item, request);
+
+        # called from the gui thread the script has already run
+        return future.result()
         
     def openProject(self):
-        # try to open project file
-        with open(self.path + ".project.json") as f:
-            self.project = json.load(f)
-            print("Name:", self.project["name"])
-            print("Mode:", self.project["mode"])
-            print("UUid:", self.project["uuid"])
+        # try to open project file unless the server already sent it
+        if not self.project:
+            with open(self.path + ".project.json") as f:
+                self.project = json.load(f)
+
+        print("Name:", self.project["name"])
+        print("Mode:", self.project["mode"])
+        print("UUid:", self.project["uuid"])
 
-            # if display code is present, then run it
-            self.runDisplay()
-            self.runApp()
+        # if display code is present, then run it
+        self.runDisplay()
+        self.runApp()
 
     def runApp(self):
         # make sure app code finds its local imports
@@ -130,8 +315,10 @@ class RunApplication(QApplication):
         self.thread = AppRunnerThread(self.path + self.project["name"]+".py")
         self.thread.start()
 
-    def execResult(self, str):
-        self.queue.put(str)            
+    def execResult(self, request, result):
+        with self.requests_lock:
+            future = self.requests.pop(request, None)
+        if future: future.set_result(result)
         
     def runDisplay(self):
         qml = os.path.join(self.path, "lib/display.qml")
@@ -139,8 +326,6 @@ class RunApplication(QApplication):
             print("No display.qml file")
             return
 
-        self.engine = QQmlApplicationEngine()
-        self.engine.addImportPath(os.path.dirname(os.path.realpath(__file__)))
         self.engine.load(qml)
 
         win = self.engine.rootObjects()[0]
@@ -150,59 +335,121 @@ class RunApplication(QApplication):
         self.doExecScript.connect(win.execScript)
         win.execResultStr.connect(self.execResult)
         win.execResultBool.connect(self.execResult)
+        self.binding = QmlBinding(win, self.execScript)
+        self.binding.index(qml)
 
         # check if something was loaded
         return bool(self.engine.rootObjects())
 
-    def on_timer(self):
-        if sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
+    # read everything that has arrived on stdin. Returns the json
+    # commands of all complete lines or None once the server is gone
+    def read_commands(self):
+        fd = sys.stdin.fileno()
+        data = b""
+        try:
+            # a pty returns a single line per read
+            while True:
+                chunk = os.read(fd, STDIN_READ)
+                if not chunk: break
+                data += chunk
+                if not select.select([fd], [], [], 0)[0]: break
+        except OSError:
+            pass
+        if not data:
+            return None
+
+        lines = (self.stdin_buffer + data).split(b"\n")
+        self.stdin_buffer = lines.pop()
+        commands = [ ]
+        for line in lines:
+            # whatever we are reading here is supposed to be json encoded
             try:
-                line = sys.stdin.readline()
-            except:
-                line = None
-                
-            data = None
-            if line:
-                # whatever we are reading here is supposed to be json encoded
-                # and since we are reading a full line it
-                # xyz
-                try:
-                    data = json.loads(line)
-                except:
-                    # ignore any malformed json input
-                    pass
-
-            if data:
-                # currently only remote commands are supported
-                if "remote" in data:
-                    for listener in  VoiceControl.listeners:
-                        listener(data["remote"])
+                data = json.loads(line)
+            except ValueError:
+                continue   # ignore any malformed json input
+            if data: commands.append(data)
+        return commands
+
+    def on_stdin(self):
+        commands = self.read_commands()
+        if commands is None:
+            self.stdin_notifier.setEnabled(False)
+            return
+        for data in commands:
+            self.handle_command(data)
+
+    def handle_command(self, data):
+        # currently only remote commands are supported
+        if "remote" in data:
+            for listener in  VoiceControl.listeners:
+                listener(data["remote"])
 
+    def warmup(self):
+        component = QQmlComponent(self.engine)
+        component.setData(WARMUP_QML, QUrl())
+
+    # wait for the server to tell us which project to run. Commands
+    # following the start are returned along
+    def wait_for_start(self):
+        while True:
+            commands = self.read_commands()
+            if commands is None:
+                return None, [ ]    # the server is gone
+
+            # ignore the pings while waiting
+            for i, data in enumerate(commands):
+                if "start" in data:
+                    return data, commands[i+1:]
+        
     def __init__(self, args):
         QApplication.__init__(self, args)
 
         self.handlers = { }
 
-        # create a timer to periodically check stdin for input
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.on_timer)
-        self.timer.start(10)
+        self.engine = QQmlApplicationEngine()
+        self.engine.addImportPath(os.path.dirname(os.path.realpath(__file__)))
 
-        # queue to pass attribute results from the gui into the app
-        self.queue = queue.Queue()
+        # handle commands from the server as soon as they arrive
+        self.stdin_buffer = b""
+        self.stdin_notifier = QSocketNotifier(sys.stdin.fileno(), QSocketNotifier.Read)
+        self.stdin_notifier.activated.connect(self.on_stdin)
+
+        # access to the display once loaded and get_attr() requests
+        # waiting for their result from the qml side
+        self.binding = None
+        self.requests = { }
+        self.request_id = 0
+        self.requests_lock = threading.Lock()
 
         # register self with gui connector
         ftgui.fttxt2_gui_connector.app = self
         
         # get project name
-        self.path = os.path.dirname(os.path.realpath(__file__))+"/workspaces/"+args[1]+"/"
+        project = args[1]
+        self.project = None
+        if project == WARM:
+            self.warmup()
+            if controller_factory and os.environ.get("FTDUINO_SOCKET"):
+                # ftduinod shares the ftDuino, so we can connect right away
+                controller_factory.create_graphical_controller()
+            start, commands = self.wait_for_start()
+            if not start: return
+            project = start["start"]
+            self.project = start.get("project")
+            for data in commands: self.handle_command(data)
+        
+        self.path = os.path.dirname(os.path.realpath(__file__))+"/workspaces/"+project+"/"
+
+        if controller_factory:
+            # connect the ftDuino while the display is being loaded
+            threading.Thread(target=controller_factory.create_graphical_controller, daemon=True).start()
 
         self.openProject()
         self.exec_()
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
-        print("Please provide a project name");
+        print("Please provide a project name or", WARM);
         sys.exit(-1)
     
     RunApplication(sys.argv)
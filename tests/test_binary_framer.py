@@ -0,0 +1,80 @@
+#
+# test_binary_framer.py
+#
+# python3 -m unittest tests/test_binary_framer.py
+
+import os, sys, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.factories import ftduino, binary_framer
+from fischertechnik.simulator import simulator
+
+class encode_test(unittest.TestCase):
+    def setUp(self):
+        self.codec = binary_framer()
+
+    def decode_payload(self, frame):
+        # sync, length, opcode, payload, crc
+        self.assertEqual(frame[0], binary_framer.SYNC)
+        self.assertEqual(frame[-1], binary_framer.crc(frame[1:-1]))
+        return frame[2], frame[3:-1]
+
+    def test_motor(self):
+        op, payload = self.decode_payload(self.codec.encode(
+            { "set": { "port": "m2", "mode": "left", "value": 255 } }))
+        self.assertEqual(op, binary_framer.OP_SET_M)
+        self.assertEqual(payload, bytes((1, binary_framer.MODES["left"], 255, 0)))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.codec.encode({ "set": { "port": "m1", "mode": "spin", "value": 100 } })
+        with self.assertRaises(ValueError):
+            self.codec.encode({ "set": { "port": "i1", "mode": "capacity" } })
+
+    def test_value_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.codec.encode({ "set": { "port": "m1", "mode": "left", "value": -128 } })
+        with self.assertRaises(ValueError):
+            self.codec.encode({ "set": { "port": "o1", "mode": "high", "value": 0x10000 } })
+        with self.assertRaises(ValueError):
+            self.codec.encode({ "set": { "port": "i1", "subscribe": True, "threshold": -1 } })
+
+    def test_invalid_port(self):
+        with self.assertRaises(ValueError):
+            self.codec.encode({ "set": { "port": "o300", "mode": "high", "value": 1 } })
+
+class writer_test(unittest.TestCase):
+    def test_writer_survives_bad_frame(self):
+        sim = simulator()
+        controller = ftduino(device="sim", backend=sim.open, protocol="json")
+        self.addCleanup(controller.close)
+        self.assertTrue(controller.online.is_set())
+
+        # encode like a binary ftDuino but catch what is written
+        written = [ ]
+        port = controller.ftduino
+        port.write = lambda data: written.append(data) or len(data)
+        controller.codec = binary_framer()
+
+        controller.set_port({ "port": "m1", "mode": "spin", "value": 1 })
+        controller.set_port({ "port": "m2", "mode": "left", "value": -5 })
+        controller.set_port({ "port": "o1", "mode": "high", "value": 255 })
+        self.wait_for(written)
+        self.assertEqual(b"".join(written), binary_framer().encode(
+            { "set": { "port": "o1", "mode": "high", "value": 255 } }))
+
+        # and it keeps going
+        written.clear()
+        controller.set_port({ "port": "o2", "mode": "low", "value": 10 })
+        self.wait_for(written)
+        self.assertEqual(b"".join(written), binary_framer().encode(
+            { "set": { "port": "o2", "mode": "low", "value": 10 } }))
+
+    def wait_for(self, written):
+        deadline = time.monotonic() + 2
+        while not written and time.monotonic() < deadline:
+            time.sleep(.01)
+        self.assertTrue(written, "nothing written")
+
+if __name__ == "__main__":
+    unittest.main()
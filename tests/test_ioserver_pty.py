@@ -0,0 +1,154 @@
+#
+# test_ioserver_pty.py
+#
+# Talk to a fake IoServer through a pty like to a real ftDuino on USB.
+#
+# python3 -m unittest tests/test_ioserver_pty.py
+
+import errno, json, os, pty, select, sys, threading, time, tty, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.factories import ftduino, json_framer
+import serial
+
+# answers json requests like the IoServer sketch. Replies can be held
+# back and are then sent in reverse order, split at awkward places
+class fake_ioserver():
+    VERSION = "0.9.3"   # json only, no push
+
+    def __init__(self):
+        self.received = [ ]
+        self.ignore = set()     # ports never answered
+        self.held = None        # replies collected instead of being sent
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, args=(self.master,), daemon=True)
+        self.thread.start()
+
+    # unplugging the ftDuino. The old pty is gone for good
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # backend for the ftduino, always opens the current pty
+    def open(self, device, baudrate):
+        return serial.Serial(self.name, baudrate, timeout=3)
+
+    def serve(self, master):
+        framer = json_framer()
+        while self.running:
+            if not select.select([ master ], [ ], [ ], .05)[0]: continue
+            try:
+                data = os.read(master, 4096)
+            except OSError as e:
+                if e.errno != errno.EIO: raise
+                time.sleep(.05)   # nobody has the pty open
+                continue
+            for cmd in framer.feed(data):
+                with self.lock: self.received.append(cmd)
+                reply = self.reply(cmd)
+                if reply == None: continue
+                with self.lock:
+                    if self.held != None:
+                        self.held.append(reply)
+                        continue
+                os.write(master, reply)
+
+    def reply(self, cmd):
+        get = cmd.get("get")
+        if get == "version":
+            return json.dumps({ "version": fake_ioserver.VERSION }).encode()
+        if get == "all":
+            return json.dumps({ "inputs": [ 100*(i+1) for i in range(8) ],
+                                "counters": [ 0 ] * 4 }).encode()
+        if isinstance(get, dict) and get.get("port") not in self.ignore:
+            port = get["port"]
+            return json.dumps({ "port": port.upper(), "value": 100*int(port[1:]) }).encode()
+        return None
+
+    def hold(self):
+        with self.lock: self.held = [ ]
+
+    # send the held replies last one first with some noise in between,
+    # a few bytes at a time
+    def release(self):
+        with self.lock:
+            held, self.held = self.held, None
+        data = b"\r\n".join(reversed(held))
+        for i in range(0, len(data), 7):
+            os.write(self.master, data[i:i+7])
+            time.sleep(.002)
+
+    def sets(self):
+        with self.lock:
+            return [ c["set"] for c in self.received if "set" in c ]
+
+class ioserver_test(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_ioserver()
+        self.controller = ftduino(device=self.server.name, protocol="json", backend=self.server.open)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(self.controller.close)
+        self.assertTrue(self.controller.online.is_set())
+
+    def test_handshake(self):
+        self.assertEqual(self.controller.version, fake_ioserver.VERSION)
+        self.assertEqual(self.controller.get_i_value(3), 300)
+
+    def test_replies_out_of_order(self):
+        # several requests in flight, replies arrive in pieces and the
+        # other way round. Each one still ends up with its caller
+        self.server.hold()
+        pending = { port: self.controller.submit("i"+str(port), { "get": { "port": "i"+str(port) } })
+                    for port in (1, 2, 5) }
+        all_inputs = self.controller.submit("all", { "get": "all" })
+        self.wait_for(lambda: len(self.server.held) == 4)
+        self.server.release()
+
+        for port, f in pending.items():
+            self.assertEqual(self.controller.result("i"+str(port), f), 100*port)
+        self.assertEqual(self.controller.result("all", all_inputs)["i8"], 800)
+
+    def test_timeout(self):
+        self.server.ignore.add("i4")
+        start = time.monotonic()
+        self.assertIsNone(self.controller.get_i_value(4))
+        self.assertGreaterEqual(time.monotonic() - start, ftduino.REPLY_TIMEOUT)
+        # the forgotten request doesn't swallow later replies
+        self.assertFalse(self.controller.pending.get("i4"))
+        self.server.ignore.clear()
+        self.assertEqual(self.controller.get_i_value(4), 400)
+
+    def test_reconnect(self):
+        self.controller.set_o_value(1, 512)
+        self.wait_for(lambda: self.server.sets())
+
+        # unplug ...
+        self.server.stop()
+        self.wait_for(lambda: not self.controller.online.is_set())
+        self.assertIsNone(self.controller.get_i_value(1))
+
+        # ... and plug in again
+        self.server.start()
+        self.assertTrue(self.controller.online.wait(5), "never reconnected")
+        self.assertEqual(self.controller.get_i_value(2), 200)
+        # the outputs are set again after the reset
+        self.wait_for(lambda: len(self.server.sets()) == 2)
+        self.assertEqual(self.server.sets()[-1], { "port": "o1", "value": 255, "mode": "high" })
+
+    def wait_for(self, condition, timeout = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(.01)
+
+if __name__ == "__main__":
+    unittest.main()
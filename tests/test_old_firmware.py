@@ -0,0 +1,41 @@
+#
+# test_old_firmware.py
+#
+# IoServers before 0.9.3 don't know "get all" and are read port by port
+#
+# python3 -m unittest tests/test_old_firmware.py
+
+import os, sys, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.factories import ftduino
+from fischertechnik.simulator import simulator
+
+class old_firmware_test(unittest.TestCase):
+    def setUp(self):
+        self.sim = simulator(version="0.9.2")
+        self.sim.inputs[2] = 1234
+        self.controller = ftduino(device="sim", backend=self.sim.open, protocol="json")
+        self.addCleanup(self.controller.close)
+        self.assertTrue(self.controller.online.is_set())
+        self.assertFalse(self.controller.supports_get_all())
+
+    def test_get_input(self):
+        start = time.monotonic()
+        self.assertEqual(self.controller.get_input("i3", .05), 1234)
+        self.assertLess(time.monotonic() - start, ftduino.REPLY_TIMEOUT)
+        # without "get all" the inputs aren't sampled in the background
+        self.assertIsNone(self.controller.sampler)
+        self.assertIsNone(self.controller.submit_all_inputs())
+
+    def test_get_all_inputs(self):
+        inputs = self.controller.get_all_inputs()
+        self.assertEqual(inputs["i3"], 1234)
+        self.assertEqual(inputs["c4"], 0)
+
+    def test_counter(self):
+        self.sim.counters[1] = 7
+        self.assertEqual(self.controller.get_input("c2", 0), 7)
+
+if __name__ == "__main__":
+    unittest.main()
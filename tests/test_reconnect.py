@@ -0,0 +1,43 @@
+#
+# test_reconnect.py
+#
+# python3 -m unittest tests/test_reconnect.py
+
+import os, sys, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.factories import ftduino
+from fischertechnik.simulator import simulator
+
+class reconnect_test(unittest.TestCase):
+    def test_plugged_in_later(self):
+        sim = simulator()
+        attempts = [ ]
+
+        # the first attempts fail like an ftDuino that isn't there yet
+        def backend(device, baudrate):
+            attempts.append(time.monotonic())
+            if len(attempts) < 3: raise OSError("no such device")
+            return sim.open(device, baudrate)
+
+        controller = ftduino(device="sim", backend=backend)
+        self.addCleanup(controller.close)
+        self.assertFalse(controller.online.is_set())
+
+        self.assertTrue(controller.online.wait(5), "never connected")
+        self.assertEqual(len(attempts), 3)
+        # backing off between the attempts
+        self.assertGreater(attempts[2] - attempts[1], attempts[1] - attempts[0])
+        self.assertEqual(controller.get_version(), sim.version)
+
+    def test_closed_while_waiting(self):
+        def backend(device, baudrate):
+            raise OSError("no such device")
+
+        controller = ftduino(device="sim", backend=backend)
+        controller.close()
+        time.sleep(.7)
+        self.assertFalse(controller.online.is_set())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+#
+# test_simulator.py
+#
+# python3 -m unittest tests/test_simulator.py
+
+import os, sys, threading, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fischertechnik.simulator import simulator
+
+class read_test(unittest.TestCase):
+    def test_timeout_with_clock_standing_still(self):
+        port = simulator(clock=lambda: 42).open()
+        port.timeout = .2
+        start = time.monotonic()
+        self.assertEqual(port.read(), b"")
+        self.assertGreaterEqual(time.monotonic() - start, .2)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_reply_wakes_reader(self):
+        port = simulator().open()
+        result = [ ]
+        reader = threading.Thread(target=lambda: result.append(port.read(100)))
+        reader.start()
+        time.sleep(.1)
+
+        start = time.monotonic()
+        port.write(b'{ "get": "version" }')
+        reader.join(1)
+        self.assertLess(time.monotonic() - start, .1)
+        self.assertIn(b'"version"', result[0])
+
+    def test_latency(self):
+        port = simulator(latency=.2).open()
+        port.write(b'{ "get": "version" }')
+        start = time.monotonic()
+        self.assertIn(b'"version"', port.read(100))
+        self.assertGreaterEqual(time.monotonic() - start, .19)
+
+    def test_default_threshold(self):
+        sim = simulator()
+        port = sim.open()
+        port.timeout = .1
+        sim.inputs[0] = 1000
+        port.write(b'{ "set": { "port": "i1", "subscribe": true } }'
+                   b'{ "set": { "port": "c1", "subscribe": true } }')
+        self.assertIn(b'"I1", "value": 1000', port.read(100))
+
+        # analog jitter isn't reported, every counted edge is
+        sim.inputs[0] = 1005
+        sim.counters[0] = 1
+        self.assertEqual(port.read(100), b'{ "event": "C1", "value": 1 }')
+        sim.inputs[0] = 1050
+        self.assertEqual(port.read(100), b'{ "event": "I1", "value": 1050 }')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,10 +8,14 @@
 # 8000 and e-g- when running on the same host as the browser can be
 # accessed from within ROBO Pro coding as localhost:8000
 #
+# The server runs on a single asyncio event loop. Streams are served
+# as coroutines, so connected clients don't cost a thread each.
+#
 # This server currently does
 # - handle cross-origin requests
 # - reply to ping
 # - reply to device port stream requests ("Schnittstellentest")
+#   - samples the ftDuino while nothing else is running
 # - process file downloads
 # - run external script on "start" request
 #   - pipes stdout into stream
@@ -20,21 +24,50 @@
 # curl -X POST http://localhost:8000/api/v1/application/project/start
 
 import argparse
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import asyncio
+import http.client
+from http import HTTPStatus
+import io
 import time
 import json
 import socket
-from socketserver import ThreadingMixIn
-import email.parser
+import email.utils
 from pathlib import Path
 import os
-import subprocess, pty, threading, select, queue
+import subprocess, pty, threading, select, codecs, signal
+import tempfile, shutil, hashlib
+from collections import deque
 from functools import partial
 from urllib.parse import unquote
 
+# without pyserial the port streams stay silent
+try:
+    from fischertechnik.factories import ftduino
+    import ftduinod
+except ImportError:
+    ftduino = None
+
 BASE = os.path.dirname(os.path.realpath(__file__))
 WORKSPACES = os.path.join(BASE, "workspaces")
 RUNNER = "run.py"
+FTDUINOD = "ftduinod.py"
+FTDUINOD_STARTUP = 5    # seconds to wait for ftduinod to accept connections
+KEEPALIVE = 15   # seconds between keepalive comments on idle streams
+CONSOLE_HISTORY = 200   # console events kept for clients resuming with Last-Event-ID
+CONSOLE_BACKLOG = 500   # console events buffered per client before the oldest are dropped
+CONSOLE_READ = 65536    # bytes read from the app's console at once
+CONSOLE_FLUSH = .05     # seconds console lines are collected before they are sent
+CONSOLE_BATCH = 500     # lines that are sent right away without waiting
+SAMPLE_RATE = 50        # ftDuino samples per second for the port streams
+RUNNER_POOL = 1         # warm runners waiting for an app to start
+UPLOAD_CHUNK = 65536    # bytes of an upload read at once
+UPLOAD_LIMIT = 64       # default size limit of uploads in MiB
+MANIFEST = ".manifest.json"   # hashes and sizes of the files of a workspace
+WORKSPACE_REFRESH = 2   # seconds the workspace index is trusted without checking the disk
+
+# uploaded files get the permissions files created by open() would get
+UMASK = os.umask(0o022)
+os.umask(UMASK)
 
 class bcolors:
     HEADER = '\033[95m'
@@ -47,10 +80,435 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-class MyHandler(BaseHTTPRequestHandler):
-    def __init__(self, ctx, *args, **kwargs):
+# a stream client waiting for data from one of the hubs
+class Subscriber():
+    def __init__(self):
+        self.closed = False
+        self.wakeup = asyncio.Event()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+    # wait for new events, returns False on timeout
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.wakeup.clear()
+        return True
+
+# a console subscriber. Events are queued by reference, the hub
+# drops the oldest ones if the client doesn't keep up. With the
+# "summarize" policy the client is told how many lines it missed
+class ConsoleSubscriber(Subscriber):
+    def __init__(self, backlog, policy):
+        super().__init__()
+        self.events = deque(maxlen=backlog)   # (encoded event, number of lines)
+        self.policy = policy
+        self.dropped = 0
+
+    def push(self, event, lines):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += self.events[0][1]
+        self.events.append((event, lines))
+        self.wakeup.set()
+
+    def take(self):
+        events = [ event for event, lines in self.events ]
+        self.events.clear()
+        if self.dropped and self.policy == "summarize":
+            # no id, the dropped lines can't be resumed anyway
+            msg = [ { "type": "text", "data": [ "... {} lines dropped ...".format(self.dropped) ] } ]
+            events.insert(0, ("data: " + json.dumps(msg) + "\n\n").encode("utf8"))
+        self.dropped = 0
+        return events
+
+# a port stream subscriber. Only the latest value of every changed
+# port is kept until the client has been served
+class PortSubscriber(Subscriber):
+    def __init__(self, values):
+        super().__init__()
+        self.changes = dict(values)
+
+    def push(self, changes):
+        self.changes.update(changes)
+        self.wakeup.set()
+
+    def take(self):
+        changes = self.changes
+        self.changes = { }
+        return changes
+
+# distributes every console event to all connected console streams.
+# Must only be used from the event loop. Event ids are "<epoch>-<n>",
+# the epoch tells ids of this server instance from those of an
+# earlier one
+class ConsoleHub():
+    def __init__(self, loop, history = CONSOLE_HISTORY, backlog = CONSOLE_BACKLOG,
+                 policy = "summarize"):
+        self.loop = loop
+        self.history = deque(maxlen=history)   # (id, encoded event, number of lines)
+        self.backlog = backlog
+        self.policy = policy
+        self.subscribers = set()
+        self.epoch = "%x" % time.time_ns()
+        self.last_id = 0
+        self.run_id = 0        # last event before the current app started
+        self.lines = [ ]       # lines waiting to be sent
+        self.flush_timer = None
+
+    # collect lines and send them in batches
+    def add_lines(self, lines):
+        self.lines.extend(lines)
+        if len(self.lines) >= CONSOLE_BATCH:
+            self.flush()
+        elif self.lines and not self.flush_timer:
+            self.flush_timer = self.loop.call_later(CONSOLE_FLUSH, self.flush)
+
+    def flush(self):
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.lines:
+            lines = self.lines
+            self.lines = [ ]
+            self.publish([ { "type": "text", "data": lines } ], len(lines))
+
+    # an app is being started. New clients get its output from here on
+    def start_run(self):
+        self.flush()
+        self.run_id = self.last_id
+
+    # encode the message once, all subscribers share the bytes
+    def publish(self, msg, lines = 1):
+        self.last_id += 1
+        event = ("id: " + self.epoch + "-" + str(self.last_id) + "\ndata: " + json.dumps(msg) + "\n\n").encode("utf8")
+        self.history.append((self.last_id, event, lines))
+        for subscriber in self.subscribers:
+            subscriber.push(event, lines)
+
+    # subscribe and return the subscriber and whether the client could
+    # be resumed from last_event_id. That's only possible if every event
+    # following it is still in the history. Otherwise the client has to
+    # start over with a clear console and gets what the current app has
+    # printed so far, as far as it's still in the history
+    def subscribe(self, last_event_id = None):
+        subscriber = ConsoleSubscriber(self.backlog, self.policy)
+        resumed = False
+        try:
+            epoch, _, last_event_id = last_event_id.rpartition("-")
+            last_event_id = int(last_event_id)
+            oldest = self.history[0][0] if self.history else self.last_id + 1
+            if epoch == self.epoch and oldest - 1 <= last_event_id <= self.last_id:
+                resumed = True
+        except (AttributeError, ValueError):
+            pass
+
+        first = last_event_id if resumed else self.run_id
+        for id, event, lines in self.history:
+            if id > first: subscriber.push(event, lines)
+        
+        self.subscribers.add(subscriber)
+        return subscriber, resumed
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        subscriber.close()
+
+# samples all inputs and counters of the ftDuino in one single
+# request (or from ftduinod's shared snapshot) and hands the changed ones to the "inputs" and "counters"
+# streams. The sampler thread only runs while somebody is watching.
+# Without ftduinod sharing the ftDuino it's also stopped while an app
+# is running, as the app needs the ftDuino for itself
+class PortHub():
+    def __init__(self, loop, rate = SAMPLE_RATE):
+        self.loop = loop
+        self.interval = 1 / rate
+        self.values = { }      # "I1" -> value as last sent to the streams
+        self.subscribers = { "inputs": set(), "counters": set() }
+        self.thread = None
+        self.stopped = threading.Event()   # tells the current sampler thread to finish
+        self.starting = None               # task waiting for the previous sampler to finish
+        self.suspended = False
+        self.samples = 0
+
+    def subscribe(self, interface):
+        prefix = "I" if interface == "inputs" else "C"
+        subscriber = PortSubscriber({ p: v for p, v in self.values.items() if p[0] == prefix })
+        self.subscribers[interface].add(subscriber)
+        self.update()
+        return subscriber
+
+    def unsubscribe(self, interface, subscriber):
+        self.subscribers[interface].discard(subscriber)
+        subscriber.close()
+        self.update()
+
+    def wanted(self):
+        return ftduino and not self.suspended and any(self.subscribers.values())
+
+    # start or stop the sampler thread as needed
+    def update(self):
+        running = self.thread and self.thread.is_alive() and not self.stopped.is_set()
+        if self.wanted() and not running and not self.starting:
+            self.starting = self.loop.create_task(self.start())
+        elif not self.wanted():
+            self.stopped.set()
+
+    async def start(self):
+        # a previous sampler may still be finishing its last request.
+        # Both must not use the ftDuino at the same time
+        if self.thread: await asyncio.to_thread(self.thread.join)
+        self.starting = None
+        if self.wanted():
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.sampler, args=(self.stopped,), daemon=True)
+            self.thread.start()
+
+    # stop sampling and release the ftDuino before an app is started
+    async def suspend(self):
+        self.suspended = True
+        self.update()
+        if self.thread: await asyncio.to_thread(self.thread.join)
+        self.values.clear()
+
+    def resume(self):
+        self.suspended = False
+        self.update()
+
+    def sampler(self, stopped):
+        # the controller connects and reconnects by itself
+        controller = ftduino()
+        last = { }
+        while not stopped.is_set():
+            if not controller.online.is_set():
+                stopped.wait(self.interval)
+                continue
+                
+            start = time.monotonic()
+            # with ftduinod this is read from shared memory
+            values = controller.get_inputs(self.interval)
+            if values:
+                self.samples += 1
+                changes = { }
+                for port, value in dict(values).items():
+                    # the ftDuino couldn't read this one, keep the last value
+                    if value is None: continue
+                    if last.get(port) != value:
+                        changes[port.upper()] = int(value)
+                        last[port] = value
+                if changes:
+                    self.loop.call_soon_threadsafe(self.publish, changes)
+            stopped.wait(max(0, self.interval - (time.monotonic() - start)))
+
+        controller.close()
+
+    def publish(self, changes):
+        self.values.update(changes)
+        for interface, prefix in ( ("inputs", "I"), ("counters", "C") ):
+            part = { p: v for p, v in changes.items() if p[0] == prefix }
+            if part:
+                for subscriber in self.subscribers[interface]:
+                    subscriber.push(part)
+
+# a run.py process with the ptys of its console and its command input
+class Runner():
+    def __init__(self, arg):
+        self.server_fd, self.client_fd = pty.openpty()
+        self.cmd_client_fd, self.cmd_server_fd = pty.openpty()
+        self.proc = subprocess.Popen( [ os.path.join(BASE, RUNNER), arg ], stdout=self.client_fd, stdin=self.cmd_client_fd )
+        # only the app needs these. Once it's gone, reading the console fails
+        os.close(self.client_fd)
+        os.close(self.cmd_client_fd)
+
+    def send(self, data):
+        # send data as newline terminated json into the subprocess
+        os.write(self.cmd_server_fd, (json.dumps(data)+"\n").encode("utf8"))
+        
+    def close(self):
+        os.close(self.server_fd)
+        os.close(self.cmd_server_fd)
+
+# keeps runners which have already imported and set up everything
+# not depending on the project. Every runner runs one app only and a
+# new one is started once the app has finished, so it doesn't compete
+# with the running app
+class RunnerPool():
+    def __init__(self, size = RUNNER_POOL):
+        self.size = size
+        self.idle = deque()
+
+    def fill(self):
+        while len(self.idle) < self.size:
+            self.idle.append(Runner("--warm"))
+
+    # return a runner running the app. A warm runner gets the parsed
+    # .project.json along if known
+    def take(self, app, project = None):
+        while self.idle:
+            runner = self.idle.popleft()
+            if runner.proc.poll() == None:
+                runner.send( { "start": app, "project": project } if project else { "start": app } )
+                return runner
+            # died while waiting
+            runner.close()
+        return Runner(app)
+
+    def close(self):
+        while self.idle:
+            runner = self.idle.popleft()
+            runner.proc.terminate()
+            runner.proc.wait()
+            runner.close()
+
+# name, uuid, mode and files of all workspaces, so requests don't
+# have to go to the disk. Workspaces changed behind our back are
+# noticed by their mtimes. The disk is only accessed from worker
+# threads, the index itself belongs to the event loop
+class WorkspaceIndex():
+    def __init__(self, base):
+        self.base = base
+        self.workspaces = { }    # name -> entry
+        self.checked = None
+        self.lock = asyncio.Lock()   # one scan at a time
+
+    def signature(self, path):
+        sig = [ ]
+        for f in ( path, os.path.join(path, ".project.json"), os.path.join(path, MANIFEST) ):
+            try:
+                sig.append(os.stat(f).st_mtime_ns)
+            except OSError:
+                sig.append(None)
+        return sig
+
+    # entry of a workspace as found on disk, None if there is none
+    def read(self, name):
+        path = os.path.join(self.base, name)
+        if not os.path.isdir(path):
+            return None
+
+        try:
+            with open(os.path.join(path, ".project.json")) as f:
+                project = json.load(f)
+        except (OSError, ValueError):
+            project = None
+
+        files = workspace_manifest(path)
+        return {
+            "name": name,
+            "path": path,
+            "uuid": project.get("uuid") if isinstance(project, dict) else None,
+            "mode": project.get("mode") if isinstance(project, dict) else None,
+            "mtime": max([ e["mtime"] for e in files.values() ] + [ os.stat(path).st_mtime_ns ]) / 1e9,
+            "project": project,
+            "files": files,
+            "signature": self.signature(path)
+        }
+
+    # names of all workspaces and fresh entries of those whose
+    # signature differs from the known one
+    def scan(self, known):
+        try:
+            names = [ e.name for e in os.scandir(self.base) if e.is_dir() and not e.name.startswith(".") ]
+        except OSError:
+            names = [ ]
+
+        return names, { name: self.read(name) for name in names
+                        if known.get(name) != self.signature(os.path.join(self.base, name)) }
+
+    def update(self, entries):
+        for name, entry in entries.items():
+            if entry: self.workspaces[name] = entry
+            else:     self.workspaces.pop(name, None)
+
+    # reload what has changed on disk since the last check. Requests
+    # arriving during a scan wait for it instead of starting their own
+    async def refresh(self):
+        async with self.lock:
+            if self.checked and time.monotonic() - self.checked < WORKSPACE_REFRESH:
+                return
+
+            known = { name: entry["signature"] for name, entry in self.workspaces.items() }
+            names, entries = await asyncio.to_thread(self.scan, known)
+            for name in list(self.workspaces):
+                if not name in names: del self.workspaces[name]
+            self.update(entries)
+            self.checked = time.monotonic()
+
+    # the workspace has just been written. Not while a scan that may
+    # have seen the old files is in progress
+    async def invalidate(self, name):
+        async with self.lock:
+            self.update({ name: await asyncio.to_thread(self.read, name) })
+
+    async def get(self, name):
+        await self.refresh()
+        return self.workspaces.get(name)
+
+    async def all(self):
+        await self.refresh()
+        return [ self.workspaces[name] for name in sorted(self.workspaces) ]
+
+# a received file on its way into a workspace
+class UploadedFile():
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(dir=directory)
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+# one handler per connection. Like http.server with HTTP/1.0 every
+# connection carries a single request
+class MyHandler():
+    def __init__(self, ctx, reader, writer):
         self.ctx = ctx
-        super().__init__(*args, **kwargs)
+        self.reader = reader
+        self.writer = writer
+        self.headers_buffer = [ ]
+
+    async def handle(self):
+        try:
+            request = await self.reader.readuntil(b"\r\n\r\n")
+            requestline, header = request.split(b"\r\n", 1)
+            self.command, self.path, self.request_version = requestline.decode("iso-8859-1").split()
+            self.headers = http.client.parse_headers(io.BytesIO(header))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError,
+                http.client.HTTPException, ConnectionError):
+            self.writer.close()
+            return
+
+        try:
+            method = getattr(self, "do_" + self.command, None)
+            if method: await method()
+            else:      self.send_error(501)
+            await self.writer.drain()
+        except ConnectionError:
+            pass    # client went away
+        finally:
+            self.writer.close()
+
+    def send_response(self, code):
+        self.headers_buffer.append("HTTP/1.0 {} {}\r\n".format(code, HTTPStatus(code).phrase))
+        self.send_header("Server", "SofTXT")
+        self.send_header("Date", email.utils.formatdate(usegmt=True))
+
+    def send_header(self, keyword, value):
+        self.headers_buffer.append("{}: {}\r\n".format(keyword, value))
+
+    def end_headers(self):
+        self.headers_buffer.append("\r\n")
+        self.writer.write("".join(self.headers_buffer).encode("latin-1"))
+        self.headers_buffer = [ ]
 
     def _set_headers(self, stream=False):
         self.send_response(200)
@@ -67,13 +525,15 @@ class MyHandler(BaseHTTPRequestHandler):
         self.send_header("Content-type", "application/json")
         self.send_header("Access-Control-Allow-Origin", "*")
         self.end_headers()
+
+    # send a server sent event. Raises ConnectionError if the client is gone
+    async def send_event(self, msg):
+        self.writer.write(("data: " + json.dumps(msg) + "\n\n").encode("utf8"))
+        await self.writer.drain()
             
     def parse_url(self, url):
         # cut off any query. We'll ignore that for now
-        parts = url.split("?")
-        url = parts[0]
-        if len(parts) > 1: query = parts[1]
-        else:              query = None
+        url = url.split("?")[0]
 
         # split url into seperate parts
         parts = url.split("/")
@@ -177,7 +637,7 @@ class MyHandler(BaseHTTPRequestHandler):
         return reply
     
         
-    def do_GET(self):
+    async def do_GET(self):
         print("GET", self.path);
         info = self.parse_url(self.path)
         
@@ -187,41 +647,45 @@ class MyHandler(BaseHTTPRequestHandler):
 
         # someone is trying to get infos about the workspacxe
         if "workspaces" in info:
+            index = self.ctx["workspaces"]
+            if not info["workspaces"]:
+                # list of all projects
+                reply = [ { k: w[k] for k in ( "name", "path", "uuid", "mode", "mtime" ) }
+                          for w in await index.all() ]
+                self._set_headers(False)
+                self.writer.write(json.dumps(reply).encode("utf8"))
+                return
+
+            workspace = await index.get(info["workspaces"])
             if not "files" in info:
                 # try to open the workspace itself
-
-                prjfile = os.path.join(WORKSPACES,info["workspaces"], ".project.json")
-                try:
-                    f = open(prjfile, "r")
-                    prjinfo = json.loads(f.read())                   
- 
+                if workspace and workspace["uuid"]:
                     reply = {
-                        "name": info["workspaces"],
-                        "path": os.path.join(WORKSPACES, info["workspaces"]),
-                        "uuid": prjinfo["uuid"]
+                        "name": workspace["name"],
+                        "path": workspace["path"],
+                        "uuid": workspace["uuid"]
                     }
                     self._set_headers(False)
                     # This is _not_ what RoboPro expects. And thus it will
                     # always assume that the project doesn't exist yet
-                    # self.wfile.write(json.dumps(reply).encode("utf8"))
-                    self.wfile.write("[]".encode("utf8"))
+                    # self.writer.write(json.dumps(reply).encode("utf8"))
+                    self.writer.write("[]".encode("utf8"))
                     return
-                except:
-                    print(bcolors.FAIL + "Project read failed:" + info["workspaces"] + bcolors.ENDC)
+                print(bcolors.FAIL + "Project read failed:" + info["workspaces"] + bcolors.ENDC)
             else:
                 # request for entire file listing
-                dir = os.path.join(WORKSPACES,info["workspaces"])
-                try:                    
+                if workspace:
                     reply = []
-                    for f in os.listdir(dir):
+                    for f, entry in sorted(workspace["files"].items()):
                         reply.append( { "name": f,
-                                        "path": os.path.join(WORKSPACES,info["workspaces"],f)
+                                        "path": os.path.join(workspace["path"], f),
+                                        "size": entry["size"],
+                                        "sha256": entry["sha256"]
                         } ) 
                     self._set_headers(False)
-                    self.wfile.write(json.dumps(reply).encode("utf8"))
+                    self.writer.write(json.dumps(reply).encode("utf8"))
                     return
-                except:
-                    print(bcolors.FAIL + "Listing failed: " + info["workspaces"] + bcolors.ENDC)
+                print(bcolors.FAIL + "Listing failed: " + info["workspaces"] + bcolors.ENDC)
                 
             self.send_error(404);
             return            
@@ -229,62 +693,74 @@ class MyHandler(BaseHTTPRequestHandler):
         self._set_headers("stream" in info)
         
         if "stream" in info:
-            # clear console on start
-            if not "inputs" in self.path and not "counters" in self.path:
-                #  "clear", "started", "finished", "text"
-                msg = [ { "type": "clear" } ]
-                data = ("data: " + json.dumps(msg) + "\n\n").encode("utf8")
-                self.wfile.write(data)
-                self.wfile.flush()
-                        
-            while(True):
-                msg = None
-                
-                if "inputs" in self.path:                
-                    # build a fake message with some delay
-                    msg = [ { "name":"I1", "value": 12 },
-                            { "name":"I2", "value": 34 },
-                            { "name":"I3", "value": 0 },
-                            { "name":"I4", "value": -100 },
-                            { "name":"I5", "value": 0 },
-                            { "name":"I6", "value": 0 },
-                            { "name":"I7", "value": 0 },
-                            { "name":"I8", "value": 0 } ]
-                    time.sleep(1);
-                elif "counters" in self.path:                    
-                    # build a fake message with some delay
-                    msg = [ { "name":"C1", "value": 12 },
-                            { "name":"C2", "value": 34 },
-                            { "name":"C3", "value": 0 },
-                            { "name":"C4", "value": 0 } ]
-                    time.sleep(1);
-                else:
-                    try:
-                        # check if there's data in the queue
-                        data = self.ctx["queue"].get(True, .1)
-                        if "text" in data:
-                            msg = [ { "type": "text", "data": [ data["text"]  ] } ]
-                    except:
-                        # send an empty message on timeout to we can detect broken
-                        # connections
-                        msg = [ ]
-                if msg:
-                    try:
-                        self.wfile.write(("data: " + json.dumps(msg) + "\n\n").encode("utf8"))
-                        self.wfile.flush()
-                    except Exception as e:
-                        print("streaming failed:", str(e));
-                        return
-                    
+            try:
+                await self.stream()
+            except ConnectionError as e:
+                print("streaming failed:", str(e));
         else:
             # dunno what to send. Send empty json message
-            self.wfile.write("[]".encode("utf8"))
+            self.writer.write("[]".encode("utf8"))
+
+    async def stream(self):
+        if "inputs" in self.path:     interface = "inputs"
+        elif "counters" in self.path: interface = "counters"
+        else:
+            await self.console_stream()
+            return
+
+        hub = self.ctx["ports"]
+        subscriber = hub.subscribe(interface)
+        watcher = asyncio.create_task(self.watch_eof(subscriber))
+        try:
+            while not subscriber.closed:
+                changes = subscriber.take()
+                if changes:
+                    await self.send_event([ { "name": p, "value": v } for p, v in sorted(changes.items()) ])
+                if not await subscriber.wait(KEEPALIVE):
+                    self.writer.write(b": keepalive\n\n")
+                    await self.writer.drain()
+        finally:
+            watcher.cancel()
+            hub.unsubscribe(interface, subscriber)
+
+    # clients never send anything after the request, so reaching eof
+    # means that the client is gone
+    async def watch_eof(self, subscriber):
+        await self.reader.read()
+        subscriber.close()
+
+    async def console_stream(self):
+        hub = self.ctx["console"]
+        subscriber, resumed = hub.subscribe(self.headers.get("Last-Event-ID"))
+        watcher = asyncio.create_task(self.watch_eof(subscriber))
+
+        try:
+            # clear console on start. A resuming client gets the missed
+            # lines instead
+            if not resumed:
+                #  "clear", "started", "finished", "text"
+                await self.send_event([ { "type": "clear" } ])
+
+            while not subscriber.closed:
+                events = subscriber.take()
+                if events:
+                    self.writer.writelines(events)
+                    await self.writer.drain()
+                    
+                if not await subscriber.wait(KEEPALIVE):
+                    # send a comment on timeout so we can detect broken
+                    # connections
+                    self.writer.write(b": keepalive\n\n")
+                    await self.writer.drain()
+        finally:
+            watcher.cancel()
+            hub.unsubscribe(subscriber)
 
     # just silently reply to optiojns
-    def do_OPTIONS(self):
+    async def do_OPTIONS(self):
         self._set_headers()
 
-    def do_DELETE(self):
+    async def do_DELETE(self):
         print("DELETE", self.path);
         
         info = self.parse_url(self.path)
@@ -297,128 +773,298 @@ class MyHandler(BaseHTTPRequestHandler):
         if "cmd" in info and info["cmd"] == "stop":
             self.stop()
 
-    def parse_multipart(self, ct, data):
-        # assemble message
-        data = ("Content-Type: "+ct+"\n\n").encode("utf8") + data;  
-        msg = email.parser.BytesParser().parsebytes(data)
+    # stream a multipart/form-data body of length bytes into temporary
+    # files in directory. Only the current chunk is held in memory. The
+    # part contents are kept as they are, binary files included. The
+    # files are created and written in worker threads, a slow SD card
+    # doesn't hold up the other connections.
+    # Returns { filename: UploadedFile } or None if the body is broken
+    async def receive_multipart(self, length, directory):
+        boundary = self.headers.get_param("boundary")
+        if not boundary: return None
 
-        reply = { }
-        for part in  msg.get_payload():
-            reply[part.get_param('filename', header='content-disposition')] = part.get_payload(decode=True).decode("utf-8");
-            
-        return reply
+        # every boundary but the very first follows a line break
+        delimiter = b"\r\n--" + boundary.encode("latin-1")
+        buffer = bytearray(b"\r\n")
+        remaining = length
+
+        async def more():
+            nonlocal remaining
+            if not remaining: return False
+            data = await self.reader.read(min(UPLOAD_CHUNK, remaining))
+            if not data: return False
+            remaining -= len(data)
+            buffer.extend(data)
+            return True
+
+        files = { }
+        part = None     # file the current part is written to
+        headers = False
+        try:
+            while True:
+                if headers:
+                    end = buffer.find(b"\r\n\r\n")
+                    if end < 0:
+                        if len(buffer) > UPLOAD_CHUNK or not await more(): return None
+                        continue
+
+                    # skip the line break ending the boundary
+                    msg = http.client.parse_headers(io.BytesIO(bytes(buffer[2:end+4])))
+                    del buffer[:end+4]
+                    headers = False
+
+                    # parts without a filename are form fields we don't need
+                    name = msg.get_param("filename", header="content-disposition")
+                    if name:
+                        part = files[name] = await asyncio.to_thread(UploadedFile, directory)
+                    continue
 
-    def save_workspace(self, name, data):
-        base = os.path.join(WORKSPACES, name)        
+                pos = buffer.find(delimiter)
+                if pos < 0:
+                    # keep what may be the beginning of a boundary
+                    keep = len(buffer) - len(delimiter) + 1
+                    if keep > 0:
+                        if part: await asyncio.to_thread(part.write, buffer[:keep])
+                        del buffer[:keep]
+                    if not await more(): return None
+                    continue
+
+                if part:
+                    await asyncio.to_thread(part.write, buffer[:pos])
+                    await asyncio.to_thread(part.close)
+                    part = None
+                del buffer[:pos+len(delimiter)]
+
+                # the last boundary is followed by "--"
+                while len(buffer) < 2:
+                    if not await more(): return None
+                if buffer[:2] == b"--":
+                    # read the rest, closing with unread data resets the connection
+                    while await more(): buffer.clear()
+                    return files
+                headers = True
+        finally:
+            if part: await asyncio.to_thread(part.close)
+
+    # move the received files into the workspace. Runs in a worker
+    # thread. Each file is replaced in one step, so a running app never
+    # sees a half written file. The workspace as a whole is not: an app
+    # started meanwhile may see some files already updated and others
+    # not yet. The manifest is written last, a save that has been
+    # interrupted just makes the next one hash the files again. Files
+    # that didn't change are left alone, so they keep their mtime and
+    # python keeps using their cached bytecode. Returns False if the
+    # workspace name is invalid
+    def save_workspace(self, name, files):
+        base = os.path.join(WORKSPACES, name)
+        if os.path.dirname(os.path.normpath(base)) != WORKSPACES:
+            print(bcolors.FAIL + "Invalid workspace: " + name + bcolors.ENDC)
+            return False
+        
         Path(base).mkdir(parents=True, exist_ok=True)
-        for i in data:
-            if i.startswith("/"): fname = os.path.join(base, i[1:])
-            else:                 fname = os.path.join(base, i)
+        manifest = workspace_manifest(base)
+        for i in files:
+            fname = os.path.normpath(os.path.join(base, i.lstrip("/")))
+            if not fname.startswith(base + os.sep):
+                print(bcolors.FAIL + "Ignoring file outside workspace: " + i + bcolors.ENDC)
+                continue
+            upload = files[i]
+            entry = manifest.get(os.path.relpath(fname, base))
+            if entry and entry["sha256"] == upload.hash.hexdigest() and entry["size"] == upload.size:
+                print(bcolors.OKCYAN + "Unchanged " + fname + bcolors.ENDC);
+                continue
+
             print(bcolors.OKCYAN + "Writing " + fname + "..." + bcolors.ENDC);
             Path(os.path.dirname(fname)).mkdir(parents=True, exist_ok=True)
-            with open(fname,'w') as f:
-                f.write(data[i])    
+            # temporary files are only readable by us
+            os.chmod(upload.path, 0o666 & ~UMASK)
+            os.replace(upload.path, fname)
+            manifest[os.path.relpath(fname, base)] = manifest_entry(os.stat(fname), upload.hash.hexdigest())
+
+        store_manifest(base, manifest)
+        return True
+
+    async def receive_workspace(self, name, length):
+        def mkdtemp():
+            # received next to the workspaces so the files can be moved
+            Path(WORKSPACES).mkdir(parents=True, exist_ok=True)
+            return tempfile.mkdtemp(prefix=".upload-", dir=WORKSPACES)
+
+        directory = await asyncio.to_thread(mkdtemp)
+        try:
+            files = await self.receive_multipart(length, directory)
+            if files is None:
+                print(bcolors.FAIL + "Incomplete upload" + bcolors.ENDC)
+                return False
+            if await asyncio.to_thread(self.save_workspace, name, files):
+                await self.ctx["workspaces"].invalidate(name)
+            return True
+        finally:
+            await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
 
     def console_handle(self, data):
         # add data to buffer an forward complete \n terminated lines only
         self.console_buffer += data.replace("\r", "")
         lines = self.console_buffer.split("\n")
         if len(lines) > 1:
-            for line in lines[:len(lines)-1]:
-                    self.ctx["queue"].put( { "text": line } )
-
+            # this runs in the console listener thread, the hub
+            # belongs to the event loop
+            self.ctx["loop"].call_soon_threadsafe(self.ctx["console"].add_lines, lines[:-1])
             self.console_buffer = lines[-1]
                 
     # thread to listen for incoming text data from app
-    def console_listener(self):
+    def console_listener(self, runner):
         self.console_buffer = ""
+        # multibyte characters may be split across reads
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
 
         # do this while no execption has accured and while the
-        # process is either starting up or running.
+        # process is running.
         e = []
-        while len(e) == 0 and (self.ctx["proc"] == None or self.ctx["proc"].poll() == None):
-            r, w, e = select.select([self.server_fd], [], [self.server_fd], 1)
+        while len(e) == 0 and runner.proc.poll() == None:
+            r, w, e = select.select([runner.server_fd], [], [runner.server_fd], 1)
             
-            if self.server_fd in r:
-                self.console_handle(os.read(self.server_fd,100).decode())
+            if runner.server_fd in r:
+                try:
+                    data = os.read(runner.server_fd, CONSOLE_READ)
+                except OSError:
+                    data = None   # app has exited
+                if not data: break
+                self.console_handle(decoder.decode(data))
 
             # frequently send a ping into the app
             self.send( { "ping": None } )
 
         print("Console listener done");
-        self.ctx["proc"] = None
-        os.close(self.server_fd)
-        os.close(self.client_fd)
-        os.close(self.ctx["cmd_server_fd"])
-        os.close(self.cmd_client_fd)
-        self.ctx["cmd_server_fd"] = None
+        # send what's left of an unterminated last line
+        tail = decoder.decode(b"", final=True)
+        if self.console_buffer or tail: self.console_handle(tail + "\n")
+        if self.ctx["runner"] is runner: self.ctx["runner"] = None
+        runner.close()
+        
+        # get ready for the next app
+        self.ctx["loop"].call_soon_threadsafe(self.ctx["runners"].fill)
+        self.ctx["loop"].call_soon_threadsafe(self.ctx["ports"].resume)
           
     def stop(self):
-        if "proc" in self.ctx and self.ctx["proc"]:
+        if self.ctx.get("runner"):
             print("Stopping running process")
-            self.ctx["proc"].terminate()
-            self.ctx["proc"] = None
+            self.ctx["runner"].proc.terminate()
         
-    def run(self, app):
+    async def run(self, app):
         print("Running", app);
+        if not os.environ.get("FTDUINO_SOCKET"):
+            await self.ctx["ports"].suspend()
 
-        self.ctx["proc"] = None
-        self.server_fd, self.client_fd = pty.openpty()
-        self.cmd_client_fd, self.ctx["cmd_server_fd"] = pty.openpty()
-        threading.Thread(target=self.console_listener, daemon=True).start()
-        
-        self.ctx["proc"] = subprocess.Popen( [ os.path.join(BASE, RUNNER), app ], stdout=self.client_fd, stdin=self.cmd_client_fd )
-        # self.ctx["proc"] = subprocess.Popen( [ os.path.join(BASE, RUNNER), app ], stdin=self.cmd_client_fd )   # without out redirection
+        workspace = await self.ctx["workspaces"].get(app)
+        self.ctx["console"].start_run()
+        runner = self.ctx["runners"].take(app, workspace["project"] if workspace else None)
+        self.ctx["runner"] = runner
+        threading.Thread(target=self.console_listener, args=(runner,), daemon=True).start()
 
     def send(self, data):
-        # send data as newline terminated json into the subprocess
-        if self.ctx["cmd_server_fd"]:
-            os.write(self.ctx["cmd_server_fd"], (json.dumps(data)+"\n").encode("utf8"))
+        runner = self.ctx.get("runner")
+        if runner:
+            try:
+                runner.send(data)
+            except OSError:
+                pass    # the app has just finished
         
-    def do_POST(self):
+    async def do_POST(self):
         print("POST", self.path);
         info = self.parse_url(self.path)
         if not info:
             self.send_error(404);
             return
 
-        self._set_headers()
-        content_len = self.headers.get('Content-Length')
-        content_type = self.headers.get('Content-Type')
+        content_len = int(self.headers.get('Content-Length') or 0)
+        content_type = self.headers.get('Content-Type') or ""
+
+        # refuse oversized bodies before reading any of them
+        if content_len > self.ctx.get("upload_limit", UPLOAD_LIMIT << 20):
+            print(bcolors.FAIL + "Upload too large: " + str(content_len) + " bytes" + bcolors.ENDC)
+            self.send_error(413)
+            return
 
         if content_len:
-            content_len = int(content_len)        
-            post_body = self.rfile.read(content_len)
-        else:
-            post_body = None
-            
-        if post_body:
-            if content_type == "application/json":
+            if content_type.split(";")[0] == "multipart/form-data":
+                # check if we know where to save this
+                if "workspaces" in info:
+                    if not await self.receive_workspace(info["workspaces"], content_len):
+                        self.send_error(400)
+                        return
+                else:
+                    await self.discard(content_len)
+
+            elif content_type == "application/json":
                 # run body through a json parser
                 try:
-                    post_data = json.loads(post_body)                   
+                    post_data = json.loads(await self.reader.readexactly(content_len))
                     print(bcolors.OKCYAN + "POST: " + str(post_data) + bcolors.ENDC);
                 except:
                     print(bcolors.FAIL + "POST decoding failed" + bcolors.ENDC)
-
-            elif content_type.split(";")[0] == "multipart/form-data":
-                post_data = self.parse_multipart(content_type, post_body);
-
-                # check if we know where to save this
-                if "workspaces" in info:
-                    self.save_workspace(info["workspaces"], post_data);
             else:
                 print(bcolors.FAIL + "Unexpected content-type:" + content_type + bcolors.ENDC)
+                await self.discard(content_len)
+
+        self._set_headers()
 
         if "application" in info and "cmd" in info and info["cmd"] == "start":
-            self.run(info["application"])
+            await self.run(info["application"])
             
         if "remote" in info:
             self.send( { "remote": info["remote"] })
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
-    
+    async def discard(self, length):
+        while length:
+            data = await self.reader.read(min(UPLOAD_CHUNK, length))
+            if not data: break
+            length -= len(data)
+
+def file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for data in iter(partial(f.read, UPLOAD_CHUNK), b""):
+            h.update(data)
+    return h.hexdigest()
+
+def manifest_entry(st, sha256):
+    return { "sha256": sha256, "size": st.st_size, "mtime": st.st_mtime_ns }
+
+# hash and size of every file of a workspace as kept in its manifest.
+# Files changed behind our back are hashed again
+def workspace_manifest(base):
+    try:
+        with open(os.path.join(base, MANIFEST)) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        stored = { }
+
+    manifest = { }
+    for dirpath, dirnames, filenames in os.walk(base):
+        dirnames[:] = [ d for d in dirnames if d != "__pycache__" ]
+        for f in filenames:
+            fname = os.path.join(dirpath, f)
+            name = os.path.relpath(fname, base)
+            if name == MANIFEST: continue
+            try:
+                st = os.stat(fname)
+                entry = stored.get(name)
+                if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+                    entry = manifest_entry(st, file_hash(fname))
+                manifest[name] = entry
+            except OSError:
+                pass   # removed meanwhile
+
+    if manifest != stored: store_manifest(base, manifest)
+    return manifest
+
+def store_manifest(base, manifest):
+    tmp = os.path.join(base, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(base, MANIFEST))
+
 def get_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -431,21 +1077,64 @@ def get_ip():
         s.close()
     return IP
 
-# run main HTTPServer
-def run(addr="localhost", port=8000):
-    server_address = (addr, port)
+async def handle_connection(ctx, reader, writer):
+    try:
+        await MyHandler(ctx, reader, writer).handle()
+    except asyncio.CancelledError:
+        writer.close()   # the server is shutting down
 
-    # create queue for console message stream (and perhaps later also
-    # device port states for the "Schnittstellentest").
-    handler = partial(MyHandler, { "queue": queue.Queue() } )
-    httpd = ThreadedHTTPServer(server_address, handler)
+async def serve(ctx, addr, port):
+    ctx["loop"] = asyncio.get_running_loop()
+    
+    # hubs for the console and the port message streams
+    ctx["console"] = ConsoleHub(ctx["loop"], policy=ctx.get("console_policy", "summarize"))
+    ctx["ports"] = PortHub(ctx["loop"], ctx.get("sample_rate", SAMPLE_RATE))
+    ctx["runners"] = RunnerPool(ctx.get("runner_pool", RUNNER_POOL))
+    ctx["runners"].fill()
+    ctx["workspaces"] = WorkspaceIndex(WORKSPACES)
+    await ctx["workspaces"].refresh()
+    
+    server = await asyncio.start_server(partial(handle_connection, ctx), addr or None, port)
 
     # if no addr was given (which is default behaviour), then
     # try to display the address used with the default route
     if not addr: addr = get_ip()
  
     print(f"Starting TXT-4.0 server on http://{addr}:{port}")
-    httpd.serve_forever()
+
+    # the server is usually stopped by SIGTERM. Wind down like on ^C,
+    # so whoever started us can clean up
+    ctx["loop"].add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        ctx["runners"].close()
+    
+# start the daemon owning the ftDuinos and let everybody use it
+def start_ftduinod(path):
+    proc = subprocess.Popen( [ os.path.join(BASE, FTDUINOD), "-s", path ] )
+    deadline = time.monotonic() + FTDUINOD_STARTUP
+    while not ftduinod.in_use(path):
+        # it exits right away if there's already one running
+        if proc.poll() not in ( None, 1 ) or time.monotonic() > deadline:
+            print(bcolors.FAIL + "ftduinod failed to start" + bcolors.ENDC)
+            proc.terminate()
+            return None
+        time.sleep(.1)
+    
+    os.environ["FTDUINO_SOCKET"] = path
+    return proc
+
+# run main server
+def run(addr="localhost", port=8000, sample_rate=SAMPLE_RATE, console_policy="summarize",
+        runner_pool=RUNNER_POOL, upload_limit=UPLOAD_LIMIT):
+    try:
+        asyncio.run(serve({ "sample_rate": sample_rate, "console_policy": console_policy,
+                            "runner_pool": runner_pool, "upload_limit": upload_limit << 20 },
+                          addr, port))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
     
 if __name__ == "__main__":
 
@@ -463,5 +1152,65 @@ if __name__ == "__main__":
         default=8000,
         help="Specify the port on which the server listens",
     )
+    parser.add_argument(
+        "--ftduino-device",
+        help="Specify the serial device of the ftDuino (default: search USB)",
+    )
+    parser.add_argument(
+        "--ftduino-baudrate",
+        type=int,
+        help="Specify the baud rate of the ftDuino link",
+    )
+    parser.add_argument(
+        "--sample-rate",
+        type=float,
+        default=SAMPLE_RATE,
+        help="Specify how often per second the ftDuino is sampled for the port streams",
+    )
+    parser.add_argument(
+        "--console-backpressure",
+        choices=[ "drop", "summarize" ],
+        default="summarize",
+        help="Specify what a console client that can't keep up is told about dropped lines",
+    )
+    parser.add_argument(
+        "--runner-pool",
+        type=int,
+        default=RUNNER_POOL,
+        help="Specify how many app runners are kept ready (0 starts a new one for every app)",
+    )
+    parser.add_argument(
+        "--upload-limit",
+        type=int,
+        default=UPLOAD_LIMIT,
+        help="Specify the largest program download accepted in MiB",
+    )
+    parser.add_argument(
+        "--ftduino-socket",
+        default=ftduinod.DEFAULT_SOCKET if ftduino else None,
+        help="Specify the socket ftduinod shares the ftDuinos on",
+    )
+    parser.add_argument(
+        "--no-ftduinod",
+        action="store_true",
+        help="Let every app open the ftDuino itself instead of sharing it through ftduinod",
+    )
     args = parser.parse_args()
-    run(addr=args.listen, port=args.port)
+
+    # the apps pick these up when creating their controller
+    if args.ftduino_device:   os.environ["FTDUINO_DEVICE"] = args.ftduino_device
+    if args.ftduino_baudrate: os.environ["FTDUINO_BAUDRATE"] = str(args.ftduino_baudrate)
+    
+    # ftduinod must not outlive us
+    daemon = None
+    try:
+        if ftduino and not args.no_ftduinod:
+            daemon = start_ftduinod(args.ftduino_socket)
+
+        run(addr=args.listen, port=args.port, sample_rate=args.sample_rate,
+            console_policy=args.console_backpressure, runner_pool=args.runner_pool,
+            upload_limit=args.upload_limit)
+    finally:
+        if daemon:
+            daemon.terminate()
+            daemon.wait()